@@ -11,60 +11,121 @@ Copyright (c) 2022, Hensen Lab
 All rights reserved.
 """
 
+import re
+from functools import lru_cache
 import numpy as np
+import h5py
 
-def phase_unwrapped_and_offset(Z):
-    phase = np.angle(Z)
-    x=np.arange(len(phase))
-    y = np.unwrap(phase)/np.pi*180
-    p = np.polyfit(x,y,1)
-    
-    return y - p[0]*x
+@lru_cache(maxsize=32)
+def _slope_weights(n):
+    """
+    x = arange(n), and the weights w such that the least squares slope of y(x) is w @ y
+    """
+    x = np.arange(n, dtype=float)
+    xc = x - np.mean(x)
+    w = xc/np.sum(xc**2) if n > 1 else np.zeros(1)
+    x.flags.writeable = False
+    w.flags.writeable = False
+    return x, w
 
-def magnitude_dB(Z):
-    return 20*np.log10(np.abs(Z))
+def _unwrap_inplace(p):
+    # np.unwrap along the last axis, writing into p
+    dd = np.diff(p, axis=-1)
+    correction = dd + np.pi
+    np.mod(correction, 2*np.pi, out=correction)
+    correction -= np.pi
+    correction[(correction == -np.pi) & (dd > 0)] = np.pi
+    correction -= dd
+    correction[np.abs(dd) < np.pi] = 0
+    np.cumsum(correction, axis=-1, out=correction)
+    p[...,1:] += correction
+
+def phase_unwrapped_and_offset(Z, axis=-1, out=None):
+    """
+    Unwrapped phase of Z in degrees, with the linear slope (e.g. from the electrical delay) removed,
+    along axis, for each trace of an N-D array of traces.
+    out: optional float array of the shape of Z to write the result into.
+    """
+    Z = np.asarray(Z)
+    if out is None:
+        out = np.empty(Z.shape)
+    np.arctan2(Z.imag, Z.real, out=out)
+    phase = np.moveaxis(out, axis, -1)
+    _unwrap_inplace(phase)
+    phase *= 180/np.pi
+    x, w = _slope_weights(phase.shape[-1])
+    slope = phase @ w
+    phase -= slope[...,None]*x
+    return out
+
+def magnitude_dB(Z, out=None):
+    """
+    20*log10(abs(Z)), out: optional float array of the shape of Z to write the result into.
+    """
+    if np.ndim(Z) == 0:
+        return 20*np.log10(np.abs(Z))
+    if out is None:
+        # the float type np.log10 would return, e.g. float64 for integer and float32 for complex64 Z
+        abs_dtype = np.abs(np.empty(0, dtype=np.asarray(Z).dtype)).dtype
+        out = np.empty(np.shape(Z), dtype=np.result_type(abs_dtype, np.float16))
+    np.abs(Z, out=out)
+    np.log10(out, out=out)
+    out *= 20
+    return out
+
+# names of the run index and completed runs datasets written by lib.measurement.Measurement
+RUN_INDEX_DSET = 'run_identifiers'
+COMPLETED_RUNS_DSET = 'completed_run_identifiers'
+GRID_RUN_IDENTIFIER = re.compile(r'\d+(?:_\d+)*')
+
+def get_run_identifiers(f, completed_only=False):
+    """
+    returns the names of the run groups in h5 file or group f, from the run index written by
+    Measurement.create_run_group if present, otherwise all groups. Identifiers of groups that
+    were removed after they were indexed are skipped.
+    completed_only: if f records completed runs, only return those, skipping interrupted runs.
+    """
+    if RUN_INDEX_DSET in f:
+        run_identifiers = [k for k in f[RUN_INDEX_DSET].asstr()[:] if isinstance(f.get(k), h5py.Group)]
+    else:
+        run_identifiers = [k for k,v in f.items() if isinstance(v, h5py.Group)]
+    if completed_only and COMPLETED_RUNS_DSET in f:
+        completed = set(f[COMPLETED_RUNS_DSET].asstr()[:])
+        run_identifiers = [k for k in run_identifiers if k in completed]
+    return run_identifiers
+
+def get_grid_indices(keys):
+    """
+    Parses the grid indices of run identifiers of the form 'i_j_k'. Other keys, and keys with a different
+    number of indices than the first valid one, are skipped.
+    returns an int array of shape (n_valid_keys, ndims), and the list of valid keys.
+    """
+    valid_keys = [k for k in keys if GRID_RUN_IDENTIFIER.fullmatch(k)]
+    if len(valid_keys) == 0:
+        return np.zeros((0,0),dtype=int), valid_keys
+    ndims = valid_keys[0].count('_') + 1
+    valid_keys = [k for k in valid_keys if k.count('_') + 1 == ndims]
+    idxs = np.array(' '.join(valid_keys).replace('_',' ').split(), dtype=int)
+    return idxs.reshape((len(valid_keys),ndims)), valid_keys
 
 def get_data_shape(f):
-    valid_keys = []
-    for k in f.keys():
-        k_split = k.split('_')
-        idxs = np.zeros(len(k_split),dtype=int)
-        is_valid = True
-        for i,ks in enumerate(k_split):
-            try:
-                idxs[i] = int(ks)
-            except:
-                is_valid = False
-                break
-        if is_valid:
-            valid_keys.append(idxs)
-    all_keys = np.array(valid_keys,dtype=int)
+    """
+    returns the grid shape spanned by the run groups 'i_j_k' in h5 file or group f.
+    """
+    all_keys, valid_keys = get_grid_indices(get_run_identifiers(f))
     return np.max(all_keys,axis=0)+1
-    # # return all_keys
-    # ndims = len(all_keys[0,:])
-    # dim_max_idxs = np.zeros(ndims,dtype=int)
-    
-    # for dim in range(ndims):
-    #     if dim+1 < ndims:
-    #         if dim == 0:
-    #             fltr = np.all(all_keys[:,1:] == 0,axis=1)
-    #         else:
-    #             fltr = np.all(all_keys[:,dim+1:] == 0,axis=1) & np.all(all_keys[:,:dim] == dim_max_idxs[:dim],axis=1)
-    #     else:
-    #         fltr = True
-    #     dim_idxs = all_keys[fltr,dim]
-    #     print(dim_idxs)
-    #     dim_idxs_sorted = np.sort(dim_idxs)
-    #     if all(np.diff(dim_idxs_sorted)) == 1:
-    #         dim_max_idxs[dim] = dim_idxs_sorted[-1]
-    #     else:
-    #         #print(dim, dim_idxs_sorted)
-    #         raise Exception('Inconsistent keys: missing indices, check file.')
-    
-    # return dim_max_idxs + 1
-        
+
+@lru_cache(maxsize=32)
+def fft_frequencies(n, d):
+    """
+    Cached np.fft.fftfreq(n, d), read only.
+    """
+    f = np.fft.fftfreq(n, d)
+    f.flags.writeable = False
+    return f
+
 def fft(x,y):
-    xfft = np.fft.fftfreq(x.shape[-1],x[1]-x[0])[1:int(len(y)/2)]
+    xfft = fft_frequencies(x.shape[-1],x[1]-x[0])[1:int(len(y)/2)]
     yfft = np.fft.fft(y)[1:int(len(y)/2)]
     return xfft,yfft
 
@@ -72,10 +133,64 @@ def max_abs_fft(x,y):
     xfft,yfft = fft(x,y)
     return xfft[np.argmax(np.abs(yfft))]
 
-def average_array(arr, averages):
-    remainder = len(arr)%averages
-    return np.mean(np.reshape(arr[:len(arr)-remainder],(-1,averages)),1)
+def average_array(arr, averages, axis=0):
+    """
+    Averages arr in bins of averages points along axis, a remainder that does not fill a bin is dropped.
+    """
+    return _bin_array(np.moveaxis(np.asarray(arr),axis,0), averages, average=True, axis=axis)
+
+def rebin_array(arr, averages, axis=0):
+    """
+    Sums arr in bins of averages points along axis, a remainder that does not fill a bin is dropped.
+    """
+    return _bin_array(np.moveaxis(np.asarray(arr),axis,0), averages, average=False, axis=axis)
+
+def _bin_array(arr, averages, average, axis):
+    # arr with the binned axis first, returns the bins with the binned axis moved back to axis
+    n = (len(arr)//averages)*averages
+    binned = np.reshape(arr[:n],(-1,averages)+arr.shape[1:])
+    binned = np.mean(binned,1) if average else np.sum(binned,1)
+    return np.moveaxis(binned,0,axis)
+
+def iter_chunks(arr, chunk_size, axis=0):
+    """
+    Yields consecutive blocks of chunk_size points along axis of an array or HDF5 dataset,
+    so only one block is in memory at a time.
+    """
+    for i in range(0, arr.shape[axis], chunk_size):
+        idx = [slice(None)]*len(arr.shape)
+        idx[axis] = slice(i, i+chunk_size)
+        yield arr[tuple(idx)]
+
+def rebin_chunks(chunks, averages, axis=0, average=False, keep_remainder=False):
+    """
+    Streaming version of rebin_array (or average_array if average): bins a sequence of chunks, e.g. 
+    iter_chunks of an HDF5 dataset, along axis, in memory of the order of one chunk. Points that do 
+    not fill a bin at the end of a chunk are carried over to the next chunk. 
+    Yields the bins of each chunk, np.concatenate(list(rebin_chunks(...)),axis=axis) gives the 
+    same result as rebin_array of the full array.
+    keep_remainder: if True, a last partially filled bin is yielded at the end, instead of dropped.
+    """
+    carry = None
+    for chunk in chunks:
+        chunk = np.moveaxis(np.asarray(chunk),axis,0)
+        if carry is not None and len(carry) > 0:
+            # complete the partial bin with the start of this chunk
+            n_fill = averages - len(carry)
+            carry = np.concatenate((carry, chunk[:n_fill]))
+            chunk = chunk[n_fill:]
+            if len(carry) < averages:
+                continue
+            yield _bin_array(carry, averages, average, axis)
+        n = (len(chunk)//averages)*averages
+        if n > 0:
+            yield _bin_array(chunk[:n], averages, average, axis)
+        carry = chunk[n:]
+    if keep_remainder and carry is not None and len(carry) > 0:
+        yield _bin_array(carry, len(carry), average, axis)
 
-def rebin_array(arr, averages):
-    remainder = len(arr)%averages
-    return np.sum(np.reshape(arr[:len(arr)-remainder],(-1,averages)),1)
+def average_chunks(chunks, averages, axis=0, keep_remainder=False):
+    """
+    Streaming version of average_array, see rebin_chunks.
+    """
+    return rebin_chunks(chunks, averages, axis=axis, average=True, keep_remainder=keep_remainder)
@@ -11,33 +11,217 @@ Copyright (c) 2022, Hensen Lab
 All rights reserved.
 """
 
-from scipy.optimize import curve_fit
+import inspect
+import logging
+import warnings
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import curve_fit, OptimizeWarning
+from scipy.signal import find_peaks
 from analysis.data_tools import max_abs_fft
 
 
-def fit(x,y,fitfunc,p0, plot_pts = 1000, plot_initial_guess=False, ignore_y_nans=True,**kwargs):
+class FitModel:
+    """
+    A fit function, with optionally its analytic jacobian jacobian(x,*p) of shape (len(x), len(p)),
+    and a function guess(x,y) returning an initial guess p0. Register models with register_model,
+    so that fit uses them automatically.
+    """
+    def __init__(self, function, jacobian=None, guess=None):
+        self.function = function
+        self.jacobian = jacobian
+        self.guess = guess
+
+MODELS = {}
+
+def register_model(function, jacobian=None, guess=None):
+    MODELS[function] = FitModel(function, jacobian=jacobian, guess=guess)
+    return MODELS[function]
+
+def get_model(fitfunc):
+    """
+    returns the registered FitModel of fitfunc, or a FitModel without jacobian and guess.
+    """
+    return MODELS.get(fitfunc, FitModel(fitfunc))
+
+class FitResult:
+    """
+    Result of fit_lean: popt, perr and pcov. The plottable arrays xp, yp of the fit result 
+    with plot_pts points are only computed when accessed.
+    Unpacks like the return value of fit: popt, perr, xp, yp = fit_lean(...)
+    """
+    def __init__(self, fitfunc, x, popt, perr, pcov=None, plot_pts=1000):
+        self.fitfunc = fitfunc
+        self.x = x
+        self.popt = popt
+        self.perr = perr
+        self.pcov = pcov
+        self.plot_pts = plot_pts
+        self._xp = None
+        self._yp = None
+
+    @property
+    def xp(self):
+        if self._xp is None:
+            self._xp = np.linspace(np.min(self.x),np.max(self.x),self.plot_pts)
+        return self._xp
+
+    @property
+    def yp(self):
+        if self._yp is None:
+            self._yp = self.fitfunc(self.xp,*self.popt)
+        return self._yp
+
+    def __iter__(self):
+        return iter((self.popt, self.perr, self.xp, self.yp))
+
+def fit_lean(x,y,fitfunc,p0=None, plot_pts = 1000, plot_initial_guess=False, ignore_y_nans=True, use_jacobian=False, **kwargs):
+    """
+    As fit, but returns a FitResult, which only evaluates the plottable fit curve when used.
+    """
+    model = get_model(fitfunc)
+    x_all = x
+    if ignore_y_nans:
+        mask = ~np.isnan(y)
+        if not np.all(mask):
+            x, y = x[mask], y[mask]
+    if p0 is None:
+        if model.guess is None:
+            raise ValueError(f'No p0 given, and no guess function registered for {fitfunc.__name__}')
+        p0 = model.guess(x,y)
+    if plot_initial_guess:
+        popt = np.array(p0)
+        return FitResult(fitfunc, x_all, popt, popt*np.inf, plot_pts=plot_pts)
+    if use_jacobian and model.jacobian is not None:
+        kwargs.setdefault('jac', model.jacobian)
+    popt, pcov = curve_fit(fitfunc, x, y, p0 =p0, **kwargs)
+    return FitResult(fitfunc, x_all, popt, np.sqrt(np.diag(pcov)), pcov=pcov, plot_pts=plot_pts)
+
+def fit(x,y,fitfunc,p0=None, plot_pts = 1000, plot_initial_guess=False, ignore_y_nans=True, use_jacobian=False, **kwargs):
     """
     Use scipy.curvefit to fit x,y with fitfunc, using initial guess p0.
+    If p0 is None, the guess function registered for fitfunc is used (see register_model).
+    If use_jacobian, the analytic jacobian registered for fitfunc is passed on as jac, 
+    instead of curve_fit estimating it with finite differences.
     kwargs are passed on to scipy.curve_fit
     returns optimal parameters popt, with standard errors perr = np.sqrt(np.diag(pcov)),
     as well as xp,yp, plottable arrays of the fitresult with plot_pts points.
+    Use fit_lean to skip computing xp,yp when they are not needed.
     """
-   
-    xp = np.linspace(np.min(x),np.max(x),plot_pts)
-    if plot_initial_guess:
-        yp = fitfunc(xp,*p0)
-        popt = np.array(p0)
-        perr = popt*np.inf
+    popt, perr, xp, yp = fit_lean(x, y, fitfunc, p0=p0, plot_pts=plot_pts, plot_initial_guess=plot_initial_guess,
+                                  ignore_y_nans=ignore_y_nans, use_jacobian=use_jacobian, **kwargs)
+    return popt, perr, xp, yp
+
+def _guess_rows(model, X, Y):
+    """
+    returns the guess of model for each row of Y(X), or None for rows where the guess failed.
+    """
+    guesses = []
+    for i in range(len(Y)):
+        mask = ~(np.isnan(X[i]) | np.isnan(Y[i]))
+        try:
+            guesses.append(np.asarray(model.guess(X[i,mask], Y[i,mask]), dtype=float))
+        except (RuntimeError, ValueError, TypeError, IndexError, np.linalg.LinAlgError):
+            guesses.append(None)
+    return guesses
+
+def _stack_guesses(model, guesses):
+    """
+    Stacks the row guesses into an array of shape (n_rows, n_params), NaN for failed guesses.
+    n_params is the most common number of guessed parameters, e.g. of the number of peaks found for 
+    n_lorentz_function_linoff, rows with a different number of parameters are NaN.
+    """
+    lengths = [len(g) for g in guesses if g is not None]
+    if len(lengths) > 0:
+        values, counts = np.unique(lengths, return_counts=True)
+        n_params = values[np.argmax(counts)]
     else:
-        if ignore_y_nans:
-            x = x[~np.isnan(y)]
-            y = y[~np.isnan(y)]
-        popt, pcov = curve_fit(fitfunc, x, y, p0 =p0, **kwargs)
-        perr = np.sqrt(np.diag(pcov))
-        yp = fitfunc(xp,*popt)
+        parameters = inspect.signature(model.function).parameters.values()
+        if any(p.kind == inspect.Parameter.VAR_POSITIONAL for p in parameters):
+            raise ValueError(f'The guess of {model.function.__name__} failed for all rows')
+        n_params = len(parameters) - 1
+    P0 = np.full((len(guesses), n_params), np.nan)
+    n_other = 0
+    for i,g in enumerate(guesses):
+        if g is not None and len(g) == n_params:
+            P0[i] = g
+        elif g is not None:
+            n_other += 1
+    if n_other > 0:
+        logging.warning(f'{n_other} rows guessed a different number of parameters than {n_params}, their fits are skipped')
+    return P0
+
+def _fit_rows(model, X, Y, P0, use_jacobian, kwargs):
+    """
+    Fits each row of Y(X) with model from the initial guesses P0, see fit_many. 
+    Failed fits, and rows with a non-finite guess, give NaN parameters and success False.
+    """
+    n, n_params = P0.shape
+    popt = np.full((n,n_params), np.nan)
+    perr = np.full((n,n_params), np.nan)
+    success = np.zeros(n, dtype=bool)
+    if use_jacobian and model.jacobian is not None:
+        kwargs = dict(kwargs, jac=kwargs.get('jac', model.jacobian))
+    for i in range(n):
+        if not np.all(np.isfinite(P0[i])):
+            continue
+        mask = ~(np.isnan(X[i]) | np.isnan(Y[i]))
+        x, y = X[i,mask], Y[i,mask]
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', OptimizeWarning)
+                popt[i], pcov = curve_fit(model.function, x, y, p0=P0[i], **kwargs)
+            perr[i] = np.sqrt(np.diag(pcov))
+        except (RuntimeError, ValueError, TypeError, IndexError, np.linalg.LinAlgError):
+            popt[i] = np.nan
+            continue
+        success[i] = np.all(np.isfinite(perr[i]))
+    return popt, perr, success
+
+def fit_many(x, Y, fitfunc, p0=None, processes=None, chunk_size=100, use_jacobian=True, **kwargs):
+    """
+    Fits each row of the 2-D array Y with fitfunc, e.g. the timetraces of all ROIs or all sweeper loops.
+    x: 1-D array shared by all rows, or a 2-D array with an x for each row. NaNs are ignored, so rows
+       of different length can be NaN padded.
+    p0: a single initial guess for all rows, an array with a guess per row, or None to use the guess
+        function registered for fitfunc (see register_model) on each row. The number of parameters
+        is taken from p0 or the guesses, so fitfunc can also take a variable number of parameters,
+        as n_lorentz_function_linoff.
+    processes: number of worker processes, defaults to the number of cpus. The rows are divided in chunks 
+        of chunk_size. With 1, or if there is only one chunk, all rows are fitted in this process. 
+        fitfunc (and the registered guess and jacobian) should be module level functions to be used 
+        in other processes.
+    kwargs are passed on to scipy.curve_fit
 
-    return popt, perr, xp, yp
+    returns popt, perr of shape (n_rows, n_params), and a boolean array success. Rows for which the guess
+    or the fit failed are NaN and not successful, instead of raising.
+    """
+    model = fitfunc if isinstance(fitfunc, FitModel) else get_model(fitfunc)
+    Y = np.atleast_2d(Y)
+    X = np.broadcast_to(x, Y.shape)
+    if p0 is None:
+        if model.guess is None:
+            raise ValueError(f'No p0 given, and no guess function registered for {model.function.__name__}')
+        P0 = None
+    else:
+        p0 = np.asarray(p0, dtype=float)
+        P0 = np.broadcast_to(p0, (len(Y), p0.shape[-1]))
+
+    chunks = [slice(i,i+chunk_size) for i in range(0,len(Y),chunk_size)]
+    if processes == 1 or len(chunks) == 1:
+        if P0 is None:
+            P0 = _stack_guesses(model, _guess_rows(model, X, Y))
+        return _fit_rows(model, X, Y, P0, use_jacobian, kwargs)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        if P0 is None:
+            # the guesses of all rows are needed first, to know the number of parameters
+            futures = [executor.submit(_guess_rows, model, X[c], Y[c]) for c in chunks]
+            P0 = _stack_guesses(model, [g for future in futures for g in future.result()])
+        futures = [executor.submit(_fit_rows, model, X[c], Y[c], P0[c], use_jacobian, kwargs) for c in chunks]
+        results = [future.result() for future in futures]
+    popt, perr, success = [np.concatenate(r) for r in zip(*results)]
+    return popt, perr, success
 
 def guess_gauss(x,y):
     return [np.nanmax(y)-np.nanmin(y),x[np.nanargmax(np.abs(y))],(np.nanmax(x)-np.nanmin(x))/4,np.nanmean(y)-(np.nanmax(y)-np.nanmin(y))/2]  
@@ -60,12 +244,62 @@ def lorentz_function_linoff(x, a, x0, w, offset,boff):
     """
     return offset + boff*(x - x0) + a*((w/2)**2)/((x-x0)**2+(w/2)**2)
 
+def lorentz_function_linoff_jacobian(x, a, x0, w, offset, boff):
+    """
+    Analytic jacobian of lorentz_function_linoff, shape (len(x), 5), for use as jac in scipy.curve_fit
+    """
+    d = x - x0
+    h = w/2
+    D = d**2 + h**2
+    J = np.empty((len(x),5))
+    J[:,0] = h**2/D
+    J[:,1] = -boff + 2*a*h**2*d/D**2
+    J[:,2] = a*h*d**2/D**2
+    J[:,3] = 1
+    J[:,4] = d
+    return J
+
+def guess_lorentz_linoff_batch(X, Y, edge_fraction=0.1):
+    """
+    Vectorized guess for lorentz_function_linoff for each row of the 2-D arrays X, Y, for a peak or a dip.
+    The linear background is estimated from the edge_fraction of points at each edge.
+    returns an array of shape (n_rows, 5)
+    """
+    X = np.atleast_2d(X)
+    Y = np.atleast_2d(Y)
+    X = np.broadcast_to(X, Y.shape)
+    rows = np.arange(Y.shape[0])
+    n_edge = max(1, int(Y.shape[1]*edge_fraction))
+    x_left, x_right = np.nanmean(X[:,:n_edge],axis=1), np.nanmean(X[:,-n_edge:],axis=1)
+    y_left, y_right = np.nanmean(Y[:,:n_edge],axis=1), np.nanmean(Y[:,-n_edge:],axis=1)
+    boff = (y_right-y_left)/(x_right-x_left)
+    background = y_left[:,None] + boff[:,None]*(X - x_left[:,None])
+    R = Y - background
+    i0 = np.argmax(np.nan_to_num(np.abs(R)),axis=1)
+    a = R[rows,i0]
+    x0 = X[rows,i0]
+    offset = background[rows,i0]
+    # full width at half maximum from the number of points beyond half the peak height
+    dx = np.abs(np.nanmean(np.diff(X,axis=1),axis=1))
+    w = np.maximum(np.sum(R/a[:,None] > 0.5,axis=1),1)*dx
+    return np.stack([a, x0, w, offset, boff],axis=1)
+
 def double_lorentz_function_linoff(x, a1, a2, x01, x02, w1, w2, offset, boff):
     return offset + boff*(x - x01) + a1*((w1/2)**2)/((x-x01)**2+(w1/2)**2) + a2*((w2/2)**2)/((x-x02)**2+(w2/2)**2)
 
 def triple_lorentz_function_linoff(x, a1, a2, a3, x01, x02, x03, w1, w2, w3, offset, boff):
     return offset + boff*(x - x01) + a1*((w1/2)**2)/((x-x01)**2+(w1/2)**2) + a2*((w2/2)**2)/((x-x02)**2+(w2/2)**2) + a3*((w3/2)**2)/((x-x03)**2+(w3/2)**2)
 
+def n_lorentz_function_linoff(x, *p):
+    """
+    N lorentzians on a linear background, with p = a1..aN, x01..x0N, w1..wN, offset, boff,
+    the same parameter order as double_lorentz_function_linoff and triple_lorentz_function_linoff.
+    """
+    n = (len(p)-2)//3
+    a, x0, w = np.reshape(p[:3*n],(3,n,1))
+    offset, boff = p[3*n:]
+    return offset + boff*(x - x0[0]) + np.sum(a*((w/2)**2)/((x-x0)**2+(w/2)**2),axis=0)
+
 def root_lorentz_function(x, a, x0, w, offset):
     """
     return offset + np.sqrt(a*((w/2)**2)/((x-x0)**2+(w/2)**2))
@@ -174,4 +408,124 @@ def over_under_function(x,amp,ke,ki,det):
     return amp*0.25*np.abs(E0_r(x,ke,ki,det)*np.conj(Eres_r(x,ke,ki,det)) 
                            + np.conj(E0_r(x,ke,ki,det))*Eres_r(x,ke,ki,det) 
                            + E0_r(x,ke,ki,det)*np.conj(Eoff_r(x,ke,ki,det)) 
-                           + np.conj(E0_r(x,ke,ki,det))*Eoff_r(x,ke,ki,det))
\ No newline at end of file
+                           + np.conj(E0_r(x,ke,ki,det))*Eoff_r(x,ke,ki,det))
+
+
+def _lorentz_peak_jacobian(x, a, x0, w):
+    """
+    derivatives of a*((w/2)**2)/((x-x0)**2+(w/2)**2) to a, x0, w
+    """
+    d = x - x0
+    h = w/2
+    D = d**2 + h**2
+    return h**2/D, 2*a*h**2*d/D**2, a*h*d**2/D**2
+
+def gauss_jacobian(x, a, x0, sigma, offset):
+    g = np.exp(-(x-x0)**2/(2*sigma**2))
+    return np.stack([g, a*g*(x-x0)/sigma**2, a*g*(x-x0)**2/sigma**3, np.ones_like(x)],axis=-1)
+
+def lorentz_jacobian(x, a, x0, w, offset):
+    return np.stack([*_lorentz_peak_jacobian(x, a, x0, w), np.ones_like(x)],axis=-1)
+
+def double_lorentz_linoff_jacobian(x, a1, a2, x01, x02, w1, w2, offset, boff):
+    da1, dx01, dw1 = _lorentz_peak_jacobian(x, a1, x01, w1)
+    da2, dx02, dw2 = _lorentz_peak_jacobian(x, a2, x02, w2)
+    return np.stack([da1, da2, dx01-boff, dx02, dw1, dw2, np.ones_like(x), x-x01],axis=-1)
+
+def triple_lorentz_linoff_jacobian(x, a1, a2, a3, x01, x02, x03, w1, w2, w3, offset, boff):
+    da1, dx01, dw1 = _lorentz_peak_jacobian(x, a1, x01, w1)
+    da2, dx02, dw2 = _lorentz_peak_jacobian(x, a2, x02, w2)
+    da3, dx03, dw3 = _lorentz_peak_jacobian(x, a3, x03, w3)
+    return np.stack([da1, da2, da3, dx01-boff, dx02, dx03, dw1, dw2, dw3, np.ones_like(x), x-x01],axis=-1)
+
+def exp_jacobian(x, a, t, offset):
+    e = np.exp(-x/t)
+    return np.stack([e, a*e*x/t**2, np.ones_like(x)],axis=-1)
+
+def linear_jacobian(x, a, b):
+    return np.stack([x, np.ones_like(x)],axis=-1)
+
+def sin_jacobian(x, amplitude, omega, phase, offset):
+    s, c = np.sin(omega*x + phase), np.cos(omega*x + phase)
+    return np.stack([s, amplitude*c*x, amplitude*c, np.ones_like(x)],axis=-1)
+
+def decaying_sin_jacobian(x, amplitude, omega, phase, offset, decay_constant):
+    e = np.exp(-x/decay_constant)
+    s, c = np.sin(omega*x + phase), np.cos(omega*x + phase)
+    return np.stack([e*s, e*amplitude*c*x, e*amplitude*c, np.ones_like(x), amplitude*s*e*x/decay_constant**2],axis=-1)
+
+def sin_sq_jacobian(x, a, b, c, d):
+    s2 = np.sin(2*(b*x + c))
+    return np.stack([np.sin(b*x + c)**2, a*s2*x, a*s2, np.ones_like(x)],axis=-1)
+
+def n_lorentz_linoff_jacobian(x, *p):
+    n = (len(p)-2)//3
+    a, x0, w = np.reshape(p[:3*n],(3,n,1))
+    boff = p[-1]
+    da, dx0, dw = _lorentz_peak_jacobian(x, a, x0, w)
+    dx0[0] -= boff
+    return np.concatenate([da, dx0, dw, [np.ones_like(x)], [x-x0[0]]]).T
+
+def guess_n_lorentz_linoff(x, y, n_peaks=None, prominence=None, smooth_pts=5, edge_fraction=0.1):
+    """
+    Guess for n_lorentz_function_linoff, from the linear background at the edges, and the peaks 
+    (or dips, whichever is larger) of the remainder found with scipy.signal.find_peaks, 
+    after a moving average over smooth_pts points.
+    The peak heights, positions and widths (full width at half prominence) give a, x0 and w.
+    n_peaks: number of peaks, the most prominent peaks are used. If None, all peaks with at least
+        the given prominence, which defaults to 5 times the noise estimated from the point to point differences.
+    Peaks are ordered by position.
+    """
+    order = np.argsort(x)
+    x, y = np.asarray(x)[order], np.asarray(y)[order]
+    a, x0, w, offset, boff = guess_lorentz_linoff_batch(x,y,edge_fraction=edge_fraction)[0]
+    background = offset + boff*(x-x0)
+    r = y - background
+    sign = 1 if np.max(r) >= -np.min(r) else -1
+    smooth_pts = max(1, min(smooth_pts, len(r)//2))
+    r_smooth = np.convolve(sign*r, np.ones(smooth_pts)/smooth_pts, mode='same')
+    if prominence is None:
+        noise = np.median(np.abs(np.diff(r)))/(0.6745*np.sqrt(2))
+        prominence = 0 if n_peaks is not None else 5*noise/np.sqrt(smooth_pts)
+    idxs, props = find_peaks(r_smooth, prominence=prominence, width=0, rel_height=0.5)
+    if len(idxs) == 0:
+        idxs, props = find_peaks(r_smooth, prominence=0, width=0, rel_height=0.5)
+    if n_peaks is not None:
+        if len(idxs) < n_peaks:
+            raise ValueError(f'Found {len(idxs)} peaks, fewer than n_peaks={n_peaks}')
+        most_prominent = np.sort(np.argsort(props['prominences'])[::-1][:n_peaks])
+        idxs, widths = idxs[most_prominent], props['widths'][most_prominent]
+    else:
+        widths = props['widths']
+    dx = np.mean(np.diff(x))
+    a = r[idxs]
+    x0 = x[idxs]
+    w = np.maximum(widths,1)*dx
+    return list(a) + list(x0) + list(w) + [background[idxs[0]], boff]
+
+def guess_double_lorentz_linoff(x,y):
+    return guess_n_lorentz_linoff(x,y,n_peaks=2)
+
+def guess_triple_lorentz_linoff(x,y):
+    return guess_n_lorentz_linoff(x,y,n_peaks=3)
+
+def guess_lorentz(x,y):
+    return list(guess_lorentz_linoff_batch(x,y)[0,:4])
+
+def guess_lorentz_linoff(x,y):
+    return list(guess_lorentz_linoff_batch(x,y)[0])
+
+def guess_linear(x,y):
+    return list(np.polyfit(x,y,1))
+
+register_model(gauss_function, gauss_jacobian, guess_gauss)
+register_model(lorentz_function, lorentz_jacobian, guess_lorentz)
+register_model(lorentz_function_linoff, lorentz_function_linoff_jacobian, guess_lorentz_linoff)
+register_model(double_lorentz_function_linoff, double_lorentz_linoff_jacobian, guess_double_lorentz_linoff)
+register_model(triple_lorentz_function_linoff, triple_lorentz_linoff_jacobian, guess_triple_lorentz_linoff)
+register_model(n_lorentz_function_linoff, n_lorentz_linoff_jacobian, guess_n_lorentz_linoff)
+register_model(exp_function, exp_jacobian, guess_exp)
+register_model(linear_function, linear_jacobian, guess_linear)
+register_model(sin_function, sin_jacobian, guess_sin)
+register_model(decaying_sin_function, decaying_sin_jacobian)
+register_model(sin_sq_function, sin_sq_jacobian)
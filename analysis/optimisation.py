@@ -20,7 +20,9 @@ All rights reserved.
 
 import numpy as np
 import scipy.optimize
+import scipy.stats
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def minimize_bound(fun,x0,fun_args=(),LB=None,UB=None,**kwargs):
     """
@@ -83,17 +85,152 @@ def minimize_bound(fun,x0,fun_args=(),LB=None,UB=None,**kwargs):
         2.0000    4.0000
 
      """
-    x0 = np.array(x0)
+    x0 = np.array(x0, dtype=float)
+    bound_params = get_bound_params(x0, LB, UB)
+    bound_params['fun'] = fun
+
+    # transform starting values into their unconstrained
+    # surrogates. Check for infeasible starting guesses.
+    x0u = xtransform_inverse(x0, bound_params)
+    # were all the variables fixed?
+    if len(x0u) == 0:
+        logging.warning('All variables were held fixed by the applied bounds')
+        return
+    fun_args = list(fun_args)
+    fun_args.insert(0,bound_params)
+    res = scipy.optimize.minimize(intrafun,x0u,args=tuple(fun_args),**kwargs)
+    xt = xtransform(res['x'],bound_params)
+    return xt,res
+
+def least_squares_bound(fun,x0,fun_args=(),LB=None,UB=None,jac='2-point',**kwargs):
+    """
+    least_squares_bound: scipy.optimize.least_squares with bound constraints by the same
+    transformation as minimize_bound.
 
+    args: fun, x0: see help for scipy.optimize.least_squares, fun(x,*fun_args) returns the residuals
+    kwargs:
+      LB, UB - lower and upper bounds, see minimize_bound
+      jac - jacobian jac(x,*fun_args) of the residuals with respect to x, of shape (len(residuals), len(x)).
+            It is propagated analytically through the bound transformation (chain rule). Or one of
+            the finite difference schemes of scipy.optimize.least_squares, applied to the transformed problem.
+    **kwargs are passed on to scipy.optimize.least_squares
+
+    returns the optimal x, and the scipy.optimize.least_squares result in the unconstrained variables.
+    """
+    x0 = np.array(x0, dtype=float)
+    bound_params = get_bound_params(x0, LB, UB)
+    bound_params['fun'] = fun
+    bound_params['jac'] = jac
+
+    x0u = xtransform_inverse(x0, bound_params)
+    if len(x0u) == 0:
+        logging.warning('All variables were held fixed by the applied bounds')
+        return
+    # on a bound the derivative of the transformation is zero, so the jacobian column vanishes
+    # and the solver cannot move away from it: start slightly inside the bound instead
+    m = bound_params['masks']
+    scale = 1e-6*(1 + np.abs(np.where(m[1], bound_params['LB_free'], bound_params['UB_free'])))
+    x0u = np.where(m[1] | m[2], np.maximum(x0u, np.sqrt(scale)), x0u)
+    x0u = np.where(m[3], np.clip(x0u, -np.pi/2 + 1e-3, np.pi/2 - 1e-3), x0u)
+    fun_args = list(fun_args)
+    fun_args.insert(0,bound_params)
+    res = scipy.optimize.least_squares(intrafun,x0u,jac=intrajac if callable(jac) else jac,args=tuple(fun_args),**kwargs)
+    xt = xtransform(res['x'],bound_params)
+    return xt,res
+
+def _minimize_from_start(fun, x0, fun_args, LB, UB, use_least_squares, kwargs):
+    if use_least_squares:
+        xt, res = least_squares_bound(fun, x0, fun_args=fun_args, LB=LB, UB=UB, **kwargs)
+        return res['cost'], xt, res
+    xt, res = minimize_bound(fun, x0, fun_args=fun_args, LB=LB, UB=UB, **kwargs)
+    return res['fun'], xt, res
+
+def multistart_minimize_bound(fun, LB, UB, n_starts=64, fun_args=(), sampler='sobol', start_LB=None, start_UB=None,
+                              patience=None, rtol=1e-6, xtol=1e-4, processes=None, seed=None, use_least_squares=False, **kwargs):
+    """
+    Runs minimize_bound (or least_squares_bound if use_least_squares) from n_starts starting points, 
+    sampled within the bounds with a scipy.stats.qmc 'sobol' or 'lhs' sampler, in a process pool.
+
+    args: fun, LB, UB: see minimize_bound
+    kwargs:
+      start_LB, start_UB - range to sample the starting points in, defaults to LB, UB. Must be finite.
+      patience - stop once the best value has not improved by more than rtol (relative) for patience
+                 finished starts. Starts that have not begun are cancelled, starts that are already running
+                 in the pool finish in the background and are discarded. If None, all starts are run.
+      xtol - minima that are within xtol times the sampling range (start_UB - start_LB) of a lower minimum
+             in every coordinate are the same minimum found from several starts, and are returned once.
+      processes - number of worker processes, defaults to the number of cpus. With 1, runs in this process.
+                  fun should be a module level function to be used in other processes.
+    **kwargs are passed on to minimize_bound (e.g. method) or least_squares_bound.
+
+    returns the distinct minima xts (n_minima, len(LB)), their function values (for least squares the cost,
+    half the sum of squared residuals) and the optimisation results, ranked from lowest to highest value.
+    """
+    LB = np.array(LB, dtype=float)
+    UB = np.array(UB, dtype=float)
+    start_LB = LB if start_LB is None else np.array(start_LB, dtype=float)
+    start_UB = UB if start_UB is None else np.array(start_UB, dtype=float)
+    if not (np.all(np.isfinite(start_LB)) and np.all(np.isfinite(start_UB))):
+        raise ValueError('Starting points can only be sampled within finite bounds, give start_LB and start_UB')
+
+    if sampler == 'sobol':
+        qmc_sampler = scipy.stats.qmc.Sobol(d=len(LB), seed=seed)
+    elif sampler == 'lhs':
+        qmc_sampler = scipy.stats.qmc.LatinHypercube(d=len(LB), seed=seed)
+    else:
+        raise ValueError(f'Unknown sampler {sampler}, use sobol or lhs')
+    x0s = start_LB + qmc_sampler.random(n_starts)*(start_UB - start_LB)
+
+    results = []
+    best = [np.inf, 0]  # best value, number of finished starts without improvement
+    def add_result(result):
+        results.append(result)
+        if not np.isfinite(best[0]) or result[0] < best[0] - rtol*abs(best[0]):
+            best[:] = [result[0], 0]
+        else:
+            best[1] += 1
+        return patience is not None and best[1] >= patience
+
+    if processes == 1:
+        for x0 in x0s:
+            if add_result(_minimize_from_start(fun, x0, fun_args, LB, UB, use_least_squares, kwargs)):
+                break
+    else:
+        executor = ProcessPoolExecutor(max_workers=processes)
+        try:
+            futures = [executor.submit(_minimize_from_start, fun, x0, fun_args, LB, UB, use_least_squares, kwargs) for x0 in x0s]
+            for future in as_completed(futures):
+                if add_result(future.result()):
+                    break
+        finally:
+            # does not wait for the starts that are still running
+            executor.shutdown(wait=False, cancel_futures=True)
+    logging.info(f'multistart: {len(results)}/{n_starts} starts finished, best value {best[0]}')
+
+    results.sort(key=lambda r: r[0])
+    distinct = []
+    for result in results:
+        if not any(np.all(np.abs(result[1] - r[1]) <= xtol*(start_UB - start_LB)) for r in distinct):
+            distinct.append(result)
+    results = distinct
+    fvals = np.array([r[0] for r in results])
+    xts = np.array([r[1] for r in results])
+    return xts, fvals, [r[2] for r in results]
+
+def get_bound_params(x0, LB=None, UB=None):
+    """
+    returns a dict with the bounds, and the masks of each bound type over the variables that are
+    not fixed, used by xtransform and xtransform_inverse. 
+    """
     n = len(x0)
     if LB is None:
         LB = np.full(x0.shape,-np.inf)
     else:
-    	LB = np.array(LB)
+        LB = np.array(LB, dtype=float)
     if UB is None:
         UB = np.full(x0.shape,np.inf)
     else:
-    	UB=np.array(UB)
+        UB = np.array(UB, dtype=float)
 
     assert x0.shape == LB.shape
     assert x0.shape == UB.shape
@@ -101,10 +238,8 @@ def minimize_bound(fun,x0,fun_args=(),LB=None,UB=None,**kwargs):
     bound_params = {}
     bound_params['LB'] = LB
     bound_params['UB'] = UB
-    bound_params['fun'] = fun
     bound_params['n'] = n
 
-
     # type of bound:
     # 0 --> unconstrained variable
     # 1 --> lower bound only
@@ -114,48 +249,32 @@ def minimize_bound(fun,x0,fun_args=(),LB=None,UB=None,**kwargs):
     types = 1*np.isfinite(LB) + 2*np.isfinite(UB)
     types = types + 1*((types==3) & (LB==UB))
     bound_params['types'] = types
-    # transform starting values into their unconstrained
-    # surrogates. Check for infeasible starting guesses.
-    x0u = x0.copy();
-    k=0;
-
-    for i in range(n):
-        #check for infeasible starting values. Use bound.
-        if types[i] == 0:   # unconstrained variable. x0u(i) is set.
-            x0u[k] = x0[i]
-        elif types[i] == 1: # lower bound only
-            x0u[k] = np.sqrt(x0[i] - LB[i]) if x0[i]>LB[i] else 0  
-        elif types[i] == 2: # upper bound only
-            x0u[k] = np.sqrt(UB[i] - x0[i]) if x0[i]<UB[i] else 0 
-        elif types[i] == 3: # lower and upper bounds
-            if x0[i]<=LB[i]:
-                # infeasible starting value
-                x0u[k] = -np.pi/2
-            elif x0[i]>=UB[i]:
-                # infeasible starting value
-                x0u[k] = np.pi/2
-            else:
-                x0u[k] = 2*(x0[i] - LB[i])/(UB[i]-LB[i]) - 1;
-                # shift by 2*pi to avoid problems at zero in fminsearch
-                # otherwise, the initial simplex is vanishingly small
-                x0u[k] = 2*np.pi+np.arcsin(np.max([-1,np.min([1,x0u[k]])]))
-        elif types[i] == 4:  # fixed variable. drop it before fminsearch sees it.
-                             # k is not incremented for this variable.
-            continue
-        # increment k
-        k+=1
-    # if any of the unknowns were fixed, then we need to shorten
-    # x0u now.
-    x0u = x0u[:k]
-    # were all the variables fixed?
-    if k == 0:
-        logging.warning('All variables were held fixed by the applied bounds')
-        return
-    fun_args = list(fun_args)
-    fun_args.insert(0,bound_params)
-    res = scipy.optimize.minimize(intrafun,x0u,args=tuple(fun_args),**kwargs)
-    xt = xtransform(res['x'],bound_params)
-    return xt,res
+
+    # fixed variables are dropped before the optimizer sees them
+    free = types != 4
+    bound_params['free'] = free
+    bound_params['x_fixed'] = np.where(free, 0., LB)
+    bound_params['LB_free'] = LB[free]
+    bound_params['UB_free'] = UB[free]
+    bound_params['masks'] = [types[free] == t for t in range(4)]
+    return bound_params
+
+def xtransform_inverse(x0, bound_params):
+    # converts starting values into their unconstrained surrogates,
+    # infeasible starting values are moved to the bound.
+    m = bound_params['masks']
+    LB = bound_params['LB_free']
+    UB = bound_params['UB_free']
+    x = np.asarray(x0, dtype=float)[bound_params['free']]
+    x0u = np.empty(len(x))
+    x0u[m[0]] = x[m[0]]
+    x0u[m[1]] = np.sqrt(np.maximum(x[m[1]] - LB[m[1]], 0))
+    x0u[m[2]] = np.sqrt(np.maximum(UB[m[2]] - x[m[2]], 0))
+    # shift by 2*pi to avoid problems at zero in fminsearch
+    # otherwise, the initial simplex is vanishingly small
+    x0u[m[3]] = 2*np.pi + np.arcsin(np.clip(2*(x[m[3]] - LB[m[3]])/(UB[m[3]]-LB[m[3]]) - 1, -1, 1))
+    x0u[m[3]] = np.where(x[m[3]] <= LB[m[3]], -np.pi/2, np.where(x[m[3]] >= UB[m[3]], np.pi/2, x0u[m[3]]))
+    return x0u
 
 def intrafun(x,*args):
     # transform variables, then call original function
@@ -165,33 +284,41 @@ def intrafun(x,*args):
     # and call fun
     return bound_params['fun'](xtrans,*args[1:])
 
+def intrajac(x,*args):
+    # jacobian of the original function, transformed to the unconstrained variables
+    bound_params = args[0]
+    xtrans = xtransform(x,bound_params)
+    J = np.atleast_2d(bound_params['jac'](xtrans,*args[1:]))
+    return J[:,bound_params['free']]*xtransform_derivative(x,bound_params)
+
+def xtransform_derivative(x,bound_params):
+    # derivative of xtransform of each (not fixed) variable to its unconstrained surrogate
+    m = bound_params['masks']
+    LB = bound_params['LB_free']
+    UB = bound_params['UB_free']
+    x = np.asarray(x)
+    dx = np.empty(len(x))
+    dx[m[0]] = 1
+    dx[m[1]] = 2*x[m[1]]
+    dx[m[2]] = -2*x[m[2]]
+    dx[m[3]] = np.cos(x[m[3]])/2*(UB[m[3]] - LB[m[3]])
+    return dx
+
 def xtransform(x,bound_params):
-    # converts unconstrained variables into their original domains
-    xtrans = np.zeros(bound_params['n'])
-    # k allows some variables to be fixed, thus dropped from the
-    # optimization.
-    
-    types = bound_params['types']
-    LB = bound_params['LB']
-    UB = bound_params['UB']
-    k=0
-    for i in range(bound_params['n']):
-        if types[i] == 0:   # unconstrained variable. x0u(i) is set.
-            xtrans[i] = x[k]
-        elif types[i] == 1: # lower bound only
-            xtrans[i] = LB[i] + x[k]**2
-        elif types[i] == 2: # upper bound only
-            xtrans[i] = UB[i] - x[k]**2
-        elif types[i] == 3: # lower and upper bounds
-            xtrans[i] = (np.sin(x[k])+1)/2
-            xtrans[i] = xtrans[i]*(UB[i] - LB[i]) + LB[i]
-            # just in case of any floating point problems
-            xtrans[i] = np.max([LB[i],np.min([UB[i],xtrans[i]])]);
-        elif types[i] == 4:  # fixed variable. drop it before fminsearch sees it.
-                             # k is not incremented for this variable.
-            xtrans[i] = LB[i]
-            continue
-        k+=1
+    # converts unconstrained variables into their original domains,
+    # with the masks of each bound type precomputed in get_bound_params
+    m = bound_params['masks']
+    LB = bound_params['LB_free']
+    UB = bound_params['UB_free']
+    x = np.asarray(x)
+    xf = np.empty(len(x))
+    xf[m[0]] = x[m[0]]
+    xf[m[1]] = LB[m[1]] + x[m[1]]**2
+    xf[m[2]] = UB[m[2]] - x[m[2]]**2
+    # clip just in case of any floating point problems
+    xf[m[3]] = np.clip((np.sin(x[m[3]])+1)/2*(UB[m[3]] - LB[m[3]]) + LB[m[3]], LB[m[3]], UB[m[3]])
+    xtrans = bound_params['x_fixed'].copy()
+    xtrans[bound_params['free']] = xf
     return xtrans
 
 if __name__=='__main__':
@@ -202,4 +329,9 @@ if __name__=='__main__':
     xt,res = minimize_bound(rosen,[3,3],LB=[2,2],method  = 'Nelder-Mead') 
     print(xt,res)
     xt,res = minimize_bound(rosen,[3,3],LB=[2,2],UB=[4,4],method  = 'Nelder-Mead') 
-    print(xt,res)
\ No newline at end of file
+    print(xt,res)
+
+    resid = lambda x: np.array([1-x[0], np.sqrt(105)*(x[1]-x[0]**2)])
+    resid_jac = lambda x: np.array([[-1, 0], [-2*np.sqrt(105)*x[0], np.sqrt(105)]])
+    xt,res = least_squares_bound(resid,[3,3],LB=[2,2],UB=[4,4],jac=resid_jac)
+    print(xt,res)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created 2026
+
+@author: B.J.Hensen
+
+This work is licensed under the GNU Affero General Public License v3.0
+
+Copyright (c) 2026, Hensen Lab
+
+All rights reserved.
+
+Batch fitting of resonances in all run groups of a VNAMeasurement file, e.g. a power or flux sweep.
+The |S21| of each trace is fitted with lorentz_function_linoff, using vectorized initial guesses and
+the analytic jacobian, with the traces divided over a process pool (see fitting.fit_many).
+"""
+
+import re
+import logging
+import warnings
+import numpy as np
+import h5py
+
+from analysis.fitting import lorentz_function_linoff, guess_lorentz_linoff_batch, fit_many
+from analysis.data_tools import magnitude_dB, get_run_identifiers
+
+FIT_PARAMS = ['a', 'x0', 'w', 'offset', 'boff']
+
+def _run_identifier_sort_key(run_identifier):
+    return [int(k) if k.isdigit() else k for k in re.split(r'(\d+)', run_identifier)]
+
+def load_vna_runs(fp, trace_name=None, completed_only=True):
+    """
+    Loads the traces of all run groups of a VNAMeasurement file.
+    trace_name: name of the trace group to load (e.g. 'vna_S21'), defaults to the first trace found.
+    completed_only: if the file records completed runs, only load those, skipping interrupted runs.
+
+    returns run_identifiers, run_params (dict of arrays), frequencies and data (lists of arrays),
+    sorted by run_identifier.
+    """
+    run_identifiers, run_params, frequencies, data = [], [], [], []
+    with h5py.File(fp, 'r') as f:
+        for run_identifier in get_run_identifiers(f, completed_only=completed_only):
+            g = f[run_identifier]
+            trace_groups = [k for k,v in g.items() if isinstance(v, h5py.Group) and 'frequency' in v]
+            if len(trace_groups) == 0:
+                continue
+            tg = g[trace_name if trace_name is not None else trace_groups[0]]
+            data_keys = [k for k in tg.keys() if k != 'frequency']
+            run_identifiers.append(run_identifier)
+            run_params.append(dict(g.attrs))
+            frequencies.append(tg['frequency'][()])
+            data.append(tg[data_keys[0]][()])
+
+    order = sorted(range(len(run_identifiers)), key=lambda i: _run_identifier_sort_key(run_identifiers[i]))
+    run_identifiers = [run_identifiers[i] for i in order]
+    param_keys = sorted(set().union(*run_params)) if len(run_params) > 0 else []
+    run_params = {k: np.array([run_params[i].get(k, np.nan) for i in order]) for k in param_keys}
+    return run_identifiers, run_params, [frequencies[i] for i in order], [data[i] for i in order]
+
+def stack_rows(arrays):
+    """
+    Stacks 1-D arrays of possibly different length into a 2-D array, padded with NaN.
+    """
+    n = max(len(a) for a in arrays)
+    stacked = np.full((len(arrays), n), np.nan, dtype=np.result_type(*arrays, np.float64))
+    for i,a in enumerate(arrays):
+        stacked[i,:len(a)] = a
+    return stacked
+
+def fit_resonators(X, Y, p0=None, processes=None, chunk_size=50, **kwargs):
+    """
+    Fits each row of the 2-D array Y(X) with lorentz_function_linoff, using fitting.fit_many.
+    Rows may be NaN padded (see stack_rows), X may also be a single 1-D x array for all rows.
+    x is centered and scaled per row for a well conditioned fit.
+    p0: array of shape (n_rows, 5), defaults to guess_lorentz_linoff_batch
+    processes, chunk_size: see fitting.fit_many
+    kwargs are passed on to scipy.curve_fit
+
+    returns popt, perr of shape (n_rows, 5), and a boolean array success
+    """
+    Y = np.atleast_2d(Y)
+    X = np.array(np.broadcast_to(X, Y.shape), dtype=float)
+    if p0 is None:
+        p0 = guess_lorentz_linoff_batch(X, Y)
+    p0 = np.broadcast_to(p0, (len(Y), len(FIT_PARAMS)))
+
+    X[~np.isfinite(Y)] = np.nan
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning) # rows without data, which fail to fit
+        xc = np.nanmean(X, axis=1, keepdims=True)
+        xs = np.nanmax(X, axis=1, keepdims=True) - np.nanmin(X, axis=1, keepdims=True)
+        scale = np.concatenate([np.ones_like(xs), xs, xs, np.ones_like(xs), 1/xs], axis=1)
+        p0_scaled = p0/scale
+        p0_scaled[:,1] -= xc[:,0]/xs[:,0]
+        X_scaled = (X-xc)/xs
+
+    popt, perr, success = fit_many(X_scaled, Y, lorentz_function_linoff, p0=p0_scaled,
+                                   processes=processes, chunk_size=chunk_size, **kwargs)
+    popt *= scale
+    popt[:,1] += xc[:,0]
+    popt[:,2] = np.abs(popt[:,2])
+    perr *= scale
+    return popt, perr, success
+
+def fit_resonator_file(fp, trace_name=None, magnitude='linear', **kwargs):
+    """
+    Loads all run groups of a VNAMeasurement file (see load_vna_runs) and fits the resonance in each
+    trace (see fit_resonators). magnitude: 'linear' to fit |S21|, 'dB' to fit 20 log10 |S21|.
+    kwargs are passed on to fit_resonators.
+
+    returns a structured array with a row per run: the run_identifier, the run_params, the fit
+    parameters, their errors (suffix '_err'), the loaded quality factor Q = x0/w and success.
+    """
+    run_identifiers, run_params, frequencies, data = load_vna_runs(fp, trace_name=trace_name)
+    if len(run_identifiers) == 0:
+        raise ValueError(f'No VNA runs found in {fp}')
+    X = stack_rows(frequencies)
+    Y = stack_rows([magnitude_dB(d) if magnitude == 'dB' else np.abs(d) for d in data])
+    popt, perr, success = fit_resonators(X, Y, **kwargs)
+    n_failed = np.sum(~success)
+    if n_failed > 0:
+        logging.warning(f'{n_failed}/{len(success)} resonator fits failed')
+
+    reserved = set(FIT_PARAMS + [k+'_err' for k in FIT_PARAMS] + ['run_identifier', 'Q', 'success'])
+    numeric_params = {k:v for k,v in run_params.items() if v.ndim == 1 and np.issubdtype(v.dtype, np.number) and k not in reserved}
+    dtype = [('run_identifier', f'U{max(len(r) for r in run_identifiers)}')]
+    dtype += [(k, v.dtype) for k,v in numeric_params.items()]
+    dtype += [(k, np.float64) for k in FIT_PARAMS] + [(k+'_err', np.float64) for k in FIT_PARAMS]
+    dtype += [('Q', np.float64), ('success', bool)]
+    results = np.zeros(len(run_identifiers), dtype=dtype)
+    results['run_identifier'] = run_identifiers
+    for k,v in numeric_params.items():
+        results[k] = v
+    for i,k in enumerate(FIT_PARAMS):
+        results[k] = popt[:,i]
+        results[k+'_err'] = perr[:,i]
+    results['Q'] = popt[:,1]/popt[:,2]
+    results['success'] = success
+    return results
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Created 2026
+
+@author: B.J.Hensen
+
+This work is licensed under the GNU Affero General Public License v3.0
+
+Copyright (c) 2026, Hensen Lab
+
+All rights reserved.
+
+Spectral analysis of long real timetraces, e.g. the data-{i} datasets of an MCC measurement, that do not
+fit in memory. The data is read in blocks of segments from an array or HDF5 dataset, and only the
+averaged spectra are kept. Blocks can be processed in a thread pool; scipy.fft releases the GIL.
+Windows, frequency axes and zoom FFT plans are cached, so repeated calls with the same settings are cheap.
+"""
+
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+@lru_cache(maxsize=32)
+def get_window(window, nperseg):
+    """
+    Cached scipy.signal.get_window, read only.
+    """
+    w = scipy.signal.get_window(window, nperseg)
+    w.flags.writeable = False
+    return w
+
+@lru_cache(maxsize=32)
+def rfft_frequencies(nperseg, fs):
+    """
+    Cached np.fft.rfftfreq(nperseg, 1/fs), read only.
+    """
+    f = np.fft.rfftfreq(nperseg, 1/fs)
+    f.flags.writeable = False
+    return f
+
+@lru_cache(maxsize=32)
+def get_zoom_fft(nperseg, f1, f2, n_freqs, fs):
+    """
+    Cached scipy.signal.ZoomFFT plan for n_freqs frequencies from f1 to f2 (inclusive).
+    """
+    return scipy.signal.ZoomFFT(nperseg, [f1, f2], n_freqs, fs=fs, endpoint=True)
+
+def _segment_blocks(n_samples, nperseg, step, segments_per_block):
+    """
+    returns (first sample, number of segments) of each block
+    """
+    n_segments = (n_samples - nperseg)//step + 1
+    if n_segments < 1:
+        raise ValueError(f'Data of {n_samples} samples is shorter than nperseg={nperseg}')
+    return [(k*step, min(segments_per_block, n_segments-k)) for k in range(0, n_segments, segments_per_block)]
+
+def _block_power(data, start, n_seg, nperseg, step, window, detrend, transform):
+    """
+    Reads the samples of n_seg segments from start, and returns |transform(segments)|**2, one row per segment.
+    """
+    block = np.asarray(data[start:start + (n_seg-1)*step + nperseg], dtype=float)
+    segments = np.lib.stride_tricks.sliding_window_view(block, nperseg)[::step]
+    if detrend:
+        segments = scipy.signal.detrend(segments, type=detrend, axis=-1)
+    spectra = transform(segments*window)
+    return spectra.real**2 + spectra.imag**2
+
+def _map_blocks(func, blocks, max_workers):
+    if max_workers is None or max_workers <= 1:
+        return [func(block) for block in blocks]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, blocks))
+
+def _density_scale(window, fs, nperseg, one_sided_idxs):
+    scale = np.full(len(one_sided_idxs), 2/(fs*np.sum(window**2)))
+    scale[one_sided_idxs == 0] /= 2
+    if nperseg % 2 == 0:
+        scale[one_sided_idxs == nperseg//2] /= 2
+    return scale
+
+def psd(data, fs, nperseg=4096, noverlap=None, window='hann', detrend='constant', segments_per_block=256, max_workers=None):
+    """
+    Averaged (Welch) one-sided power spectral density of the real 1-D array or HDF5 dataset data,
+    equivalent to scipy.signal.welch(data, fs, window, nperseg, noverlap, detrend=detrend),
+    reading segments_per_block segments at a time.
+    max_workers: number of threads to process blocks in parallel, with at most max_workers blocks in memory.
+
+    returns frequencies f, and psd Pxx (units**2/Hz)
+    """
+    noverlap = nperseg//2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    w = get_window(window, nperseg)
+    transform = lambda segments: scipy.fft.rfft(segments, axis=-1)
+    blocks = _segment_blocks(len(data), nperseg, step, segments_per_block)
+    block_sum = lambda block: np.sum(_block_power(data, block[0], block[1], nperseg, step, w, detrend, transform), axis=0)
+    total = np.sum(_map_blocks(block_sum, blocks, max_workers), axis=0)
+    n_segments = sum(n_seg for start, n_seg in blocks)
+    f = rfft_frequencies(nperseg, fs)
+    return f, total/n_segments*_density_scale(w, fs, nperseg, np.arange(len(f)))
+
+def spectrogram(data, fs, nperseg=4096, noverlap=None, window='hann', detrend='constant', average_segments=1,
+                segments_per_block=256, max_workers=None):
+    """
+    Spectrogram of the real 1-D array or HDF5 dataset data, in time bins that each average the psd of
+    average_segments consecutive segments, to keep the result small for long timetraces.
+    See psd for the other arguments.
+
+    returns frequencies f, the times t of the center of each time bin, and Sxx of shape (len(t), len(f)).
+    A last time bin with fewer than average_segments segments is dropped.
+    """
+    noverlap = nperseg//2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    w = get_window(window, nperseg)
+    transform = lambda segments: scipy.fft.rfft(segments, axis=-1)
+    segments_per_block = max(1, segments_per_block//average_segments)*average_segments
+    blocks = _segment_blocks(len(data), nperseg, step, segments_per_block)
+    # only the last block can have a partial time bin, which is not read
+    blocks = [(start, n_seg - n_seg % average_segments) for start, n_seg in blocks]
+    blocks = [block for block in blocks if block[1] > 0]
+    def block_bins(block):
+        power = _block_power(data, block[0], block[1], nperseg, step, w, detrend, transform)
+        return np.mean(np.reshape(power, (block[1]//average_segments, average_segments, -1)), axis=1)
+    f = rfft_frequencies(nperseg, fs)
+    if len(blocks) == 0:
+        Sxx = np.zeros((0, len(f)))
+    else:
+        Sxx = np.concatenate(_map_blocks(block_bins, blocks, max_workers))
+    Sxx *= _density_scale(w, fs, nperseg, np.arange(len(f)))
+    t = (np.arange(len(Sxx))*average_segments*step + ((average_segments-1)*step + nperseg)/2)/fs
+    return f, t, Sxx
+
+def zoom_psd(data, fs, f1, f2, n_freqs=1001, nperseg=4096, noverlap=None, window='hann', detrend='constant',
+             segments_per_block=256, max_workers=None):
+    """
+    Averaged one-sided power spectral density of the real 1-D array or HDF5 dataset data, at n_freqs
+    frequencies from f1 to f2, computed with a zoom FFT (chirp z-transform) of each segment.
+    This gives a finer frequency grid in a narrow band than a full FFT of the same segments,
+    the resolution bandwidth is still set by nperseg. See psd for the other arguments.
+
+    returns frequencies f, and psd Pxx (units**2/Hz)
+    """
+    noverlap = nperseg//2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    w = get_window(window, nperseg)
+    transform = get_zoom_fft(nperseg, float(f1), float(f2), n_freqs, float(fs))
+    blocks = _segment_blocks(len(data), nperseg, step, segments_per_block)
+    block_sum = lambda block: np.sum(_block_power(data, block[0], block[1], nperseg, step, w, detrend, transform), axis=0)
+    total = np.sum(_map_blocks(block_sum, blocks, max_workers), axis=0)
+    n_segments = sum(n_seg for start, n_seg in blocks)
+    f = np.linspace(f1, f2, n_freqs)
+    scale = np.full(n_freqs, 2/(fs*np.sum(w**2)))
+    scale[(f == 0) | (f == fs/2)] /= 2
+    return f, total/n_segments*scale
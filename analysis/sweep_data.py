@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Created 2026
+
+@author: B.J.Hensen
+
+This work is licensed under the GNU Affero General Public License v3.0
+
+Copyright (c) 2026, Hensen Lab
+
+All rights reserved.
+
+Assembles the run groups 'i_j_k' of a sweep (e.g. from ParameterSweep) into N-D arrays,
+labelled with coordinates taken from the run_params.
+"""
+
+import warnings
+import numpy as np
+import h5py
+
+from analysis.data_tools import get_run_identifiers, get_grid_indices
+
+
+class SweepData:
+    """
+    Datasets of all run groups of a sweep, in arrays of shape grid_shape + dataset shape.
+
+    attributes:
+        shape: the grid shape
+        dims: names of the grid dimensions, the run_param that sets the coordinate along that dimension,
+              or 'dim_{d}' if there is none
+        coords: dict with the coordinate values along each named dimension
+        data: dict of dataset path within the run group (e.g. 'vna_S21/S21') -> array
+        run_params: dict of run_param name -> array of the grid shape, NaN where not measured
+        measured: boolean array of the grid shape, False for grid points without a run group
+    """
+    def __init__(self, shape, dims, coords, data, run_params, measured):
+        self.shape = shape
+        self.dims = dims
+        self.coords = coords
+        self.data = data
+        self.run_params = run_params
+        self.measured = measured
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+    def index(self, dim, value):
+        """
+        returns the index along dim of the coordinate nearest to value
+        """
+        return int(np.nanargmin(np.abs(self.coords[dim] - value)))
+
+    def sel(self, key, **coords):
+        """
+        returns data[key] at the grid points nearest to the given coordinates, e.g. sel('vna_S21/S21', power=-20)
+        """
+        idx = [slice(None)]*len(self.shape)
+        for dim, value in coords.items():
+            idx[self.dims.index(dim)] = self.index(dim, value)
+        return self.data[key][tuple(idx)]
+
+
+def _find_datasets(group, prefix=''):
+    paths = []
+    for k, v in group.items():
+        if isinstance(v, h5py.Dataset):
+            paths.append(prefix + k)
+        elif isinstance(v, h5py.Group):
+            paths += _find_datasets(v, prefix + k + '/')
+    return paths
+
+def _fill_value(dtype):
+    if np.issubdtype(dtype, np.inexact):
+        return np.nan
+    return 0
+
+def get_dim_coords(run_params, shape):
+    """
+    For each dimension of the grid, finds a numeric run_param that only changes along that dimension.
+    returns the dims names and a dict of coordinates.
+    """
+    dims = [f'dim_{d}' for d in range(len(shape))]
+    coords = {}
+    for name, values in run_params.items():
+        if not np.issubdtype(values.dtype, np.number):
+            continue
+        for d in range(len(shape)):
+            if dims[d] in coords or shape[d] < 2:
+                continue
+            other_axes = tuple(a for a in range(len(shape)) if a != d)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning) # all-NaN slices of unmeasured points
+                c = np.nanmean(values, axis=other_axes) if len(other_axes) > 0 else values
+            expanded = np.expand_dims(c, other_axes)
+            is_coord = np.all(np.isclose(values, expanded, equal_nan=True) | np.isnan(values))
+            if is_coord and np.any(np.diff(c[np.isfinite(c)]) != 0):
+                dims[d] = name
+                coords[name] = c
+                break
+    return dims, coords
+
+def load_sweep(fp, datasets=None, completed_only=True):
+    """
+    Loads all run groups 'i_j_k' of the HDF5 file fp into a SweepData.
+    datasets: paths of the datasets within the run groups to load, defaults to all datasets of the first run group.
+    completed_only: if the file records completed runs, only load those, skipping interrupted runs,
+        as resonator_fitting.load_vna_runs.
+
+    The arrays of the grid are allocated once, and each run group is read directly into them, one group
+    at a time: h5py serializes reads within a process, so reading groups on several threads would not be faster.
+    Grid points without a (completed) run group are NaN (or 0 for integer datasets).
+    """
+    with h5py.File(fp, 'r') as f:
+        idxs, keys = get_grid_indices(get_run_identifiers(f, completed_only=completed_only))
+        if len(keys) == 0:
+            raise ValueError(f'No run groups of the form i_j_k found in {fp}')
+        shape = tuple(int(n) for n in np.max(idxs, axis=0) + 1)
+        if datasets is None:
+            datasets = _find_datasets(f[keys[0]])
+
+        data = {}
+        for path in datasets:
+            ds = f[keys[0]][path]
+            data[path] = np.full(shape + ds.shape, _fill_value(ds.dtype), dtype=ds.dtype)
+        measured = np.zeros(shape, dtype=bool)
+        params = {}
+
+        for idx, key in zip(idxs, keys):
+            idx = tuple(idx)
+            g = f[key]
+            for path in datasets:
+                ds = g[path]
+                if ds.shape != data[path].shape[len(shape):]:
+                    raise ValueError(f'{key}/{path} has shape {ds.shape}, expected {data[path].shape[len(shape):]}')
+                ds.read_direct(data[path], dest_sel=idx)
+            for k, v in g.attrs.items():
+                if np.ndim(v) == 0 and isinstance(v, (int, float, np.number)):
+                    if k not in params:
+                        params[k] = np.full(shape, np.nan)
+                    params[k][idx] = v
+            measured[idx] = True
+
+    dims, coords = get_dim_coords(params, shape)
+    return SweepData(shape, dims, coords, data, params, measured)
@@ -3,10 +3,14 @@ Almost identical to https://microsoft.github.io/Qcodes/_modules/qcodes/instrumen
 
 """
 
+import time
+import asyncio
+from datetime import datetime
 import logging
 import numpy as np
 from functools import partial
-from typing import Optional, Any, Tuple
+from contextlib import contextmanager
+from typing import Optional, Any, Tuple, Dict, List, Callable, Sequence
 
 from qcodes import VisaInstrument, Instrument
 from qcodes import ChannelList, InstrumentChannel
@@ -282,7 +286,183 @@ class FrequencySweep(ArrayParameter):
         return self.instrument._get_sweep_data()
 
 
+class ZNBSweepFuture:
+    """
+    Handle to sweeps running on the VNA, started without blocking.
+    init_cmd is sent once, followed by *OPC, which sets the operation
+    complete bit of the event status register once all sweeps it started
+    are finished. The bit is polled with *ESR?. This keeps python (and
+    e.g. plots) responsive and avoids long VISA timeouts.
+
+    To take several sweeps, e.g. the averages, with a single trigger, set
+    the sweep count of the channels (see ZNBTrace.sweep_count) before
+    creating the future: the VNA then runs them back to back, and only
+    the final *OPC is polled. Use wait() to block with an optional
+    callback between polls, or await the future in a coroutine.
+
+    Args:
+        instrument: the ZNB
+        init_cmd: the command to start the sweeps, e.g. "INIT1:IMM"
+        poll_interval: time (s) between polls in wait and await
+        timeout: timeout (s) of await and the default of wait, e.g. the
+            expected duration of the sweeps plus some margin. None to wait
+            indefinitely.
+    """
+
+    def __init__(
+        self,
+        instrument: "ZNB",
+        init_cmd: str,
+        poll_interval: float = 0.1,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self._instrument = instrument
+        self._done = False
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # *ESR? clears the event status register before the sweeps are
+        # started, unlike *CLS it leaves the error queue intact
+        self._instrument.ask(f"*ESR?;{init_cmd};*OPC")
+
+    def done(self) -> bool:
+        if not self._done:
+            self._done = bool(int(self._instrument.ask("*ESR?")) & 1)
+        return self._done
+
+    def wait(
+        self,
+        timeout: Optional[float] = None,
+        callback: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        """
+        Polls until all sweeps are done. If given, callback is called
+        between polls instead of sleeping poll_interval. timeout defaults
+        to the timeout of the future.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        t0 = time.time()
+        while not self.done():
+            if timeout is not None and time.time() - t0 > timeout:
+                raise TimeoutError(f"VNA sweep not complete after {timeout} s")
+            if callback is not None:
+                callback()
+            else:
+                time.sleep(self.poll_interval)
+
+    def __await__(self):
+        t0 = time.time()
+        while not self.done():
+            if self.timeout is not None and time.time() - t0 > self.timeout:
+                raise TimeoutError(f"VNA sweep not complete after {self.timeout} s")
+            yield from asyncio.sleep(self.poll_interval).__await__()
+
+
+class ZNBCWStream:
+    """
+    Continuous CW time trace acquisition, block by block. Each block is
+    one CW sweep of one of the traces, read out as I and Q.
+
+    With a single trace, the readout of a block is dead time before the
+    next sweep is started. With two traces on different channels, set up
+    identically in CW mode, the sweeps alternate between the channels:
+    as soon as one sweep is complete the sweep of the other channel is
+    started, and the finished one is read out while the other sweeps.
+    The dead time is then only the *OPC poll and trigger latency.
+
+    Args:
+        traces: one or two ZNBTraces set up with setup_cw_sweep
+        poll_interval: time (s) between *ESR? polls while waiting for a
+            sweep
+    """
+
+    def __init__(
+        self, traces: Sequence["ZNBTrace"], poll_interval: float = 0.001
+    ) -> None:
+        if len(traces) not in (1, 2):
+            raise ValueError("Streaming requires one or two traces")
+        if len(set(trace._ch for trace in traces)) != len(traces):
+            raise ValueError("Double buffered traces must be on different channels")
+        self.traces = list(traces)
+        self.poll_interval = poll_interval
+        self._future: Optional[ZNBSweepFuture] = None
+        self._sweeping = 0
+        self._t_start = 0.0
+
+    def check_setup(self) -> None:
+        """
+        Checks that all traces are in CW mode with the same frequency,
+        number of points and bandwidth.
+        """
+        for trace in self.traces:
+            trace._check_cw_sweep()
+        settings = [
+            (trace.cw_frequency(), trace.npts(), trace.bandwidth())
+            for trace in self.traces
+        ]
+        if len(set(settings)) > 1:
+            raise RuntimeError(
+                "Double buffered traces have different CW settings "
+                f"(frequency, npts, bandwidth): {settings}"
+            )
+
+    @property
+    def npts(self) -> int:
+        return self.traces[0].npts.cache.get()
+
+    @property
+    def block_duration(self) -> float:
+        return self.npts / self.traces[0].bandwidth.cache.get()
+
+    def _start_sweep(self, k: int) -> None:
+        self._sweeping = k
+        self._t_start = time.time()
+        self._future = ZNBSweepFuture(
+            self.traces[k].root_instrument,
+            f"INIT{self.traces[k]._ch}:IMM",
+            poll_interval=self.poll_interval,
+            timeout=self.block_duration + self.traces[k]._additional_wait,
+        )
+
+    def start(self) -> None:
+        self.check_setup()
+        self._start_sweep(0)
+
+    def get_block(
+        self, timeout: Optional[float] = None
+    ) -> Tuple[float, int, np.ndarray, np.ndarray]:
+        """
+        Waits for the running sweep, starts the next one and reads out the
+        finished one.
+
+        Returns (t_start, k, i, q): the time.time() at which the sweep was
+        triggered, the index of the trace that took it, and its I and Q.
+        """
+        if self._future is None:
+            raise RuntimeError("Stream is not started")
+        self._future.wait(timeout=timeout)
+        k, t_start = self._sweeping, self._t_start
+        if len(self.traces) == 2:
+            self._start_sweep(1 - k)
+            i, q = self.traces[k]._read_cw_data()
+        else:
+            i, q = self.traces[k]._read_cw_data()
+            self._start_sweep(k)
+        return t_start, k, i, q
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Waits for the running sweep to finish, and discards it.
+        """
+        if self._future is not None:
+            self._future.wait(timeout=timeout)
+            self._future = None
+
+
 class ZNBTrace(InstrumentChannel):
+    # maximum number of points of a sweep, also of all segments together
+    MAX_SWEEP_POINTS = 100001
+
     def __init__(
         self,
         parent: "ZNB",
@@ -309,6 +489,11 @@ class ZNBTrace(InstrumentChannel):
         self._ch = channel
         # Additional wait when adjusting instrument timeout to sweep time.
         self._additional_wait = 100
+        # segment table of the channel as last set by set_segments
+        self._segments: List[Dict[str, float]] = []
+        # writes queued inside the configure context, None outside of it
+        self._queued_writes: Optional[List[str]] = None
+        self._requested_sweep: Dict[str, float] = {}
 
         if existing_trace_to_bind_to is None:
             self._tracename = f"Trc{name}"
@@ -498,6 +683,16 @@ class ZNBTrace(InstrumentChannel):
             get_parser=float,
             unit="s",
         )
+        self.add_parameter(
+            name="sweep_count",
+            label="Sweep count",
+            get_cmd=f"SENS{self._ch}:SWE:COUN?",
+            set_cmd=f"SENS{self._ch}:SWE:COUN {{:d}}",
+            get_parser=int,
+            vals=vals.Ints(1, 999999),
+            docstring="Number of sweeps taken by a single trigger when "
+            "continuous measurement is off.",
+        )
         self.add_parameter(
             name="sweep_type",
             get_cmd=f"SENS{self._ch}:SWE:TYPE?",
@@ -631,51 +826,68 @@ class ZNBTrace(InstrumentChannel):
 
     def _set_start(self, val: float) -> None:
         self.write(f"SENS{self._ch}:FREQ:START {val:.7f}")
-        stop = self.stop()
+        if self._queued_writes is not None:
+            self._requested_sweep["start"] = val
+            return
+        start, stop, npts = self._get_sweep_settings()
         if val >= stop:
             raise ValueError("Stop frequency must be larger than start "
                              "frequency.")
         # we get start as the vna may not be able to set it to the
         # exact value provided.
-        start = self.start()
         if abs(val - start) >= 1:
             log.warning(
                 "Could not set start to {} setting it to "
                 "{}".format(val, start)
             )
-        self.update_lin_traces()
+        self._update_lin_traces(start, stop, npts)
 
     def _set_stop(self, val: float) -> None:
-        start = self.start()
-        if val <= start:
-            raise ValueError("Stop frequency must be larger than start "
-                             "frequency.")
+        if self._queued_writes is not None:
+            self.write(f"SENS{self._ch}:FREQ:STOP {val:.7f}")
+            self._requested_sweep["stop"] = val
+            return
         self.write(f"SENS{self._ch}:FREQ:STOP {val:.7f}")
         # We get stop as the vna may not be able to set it to the
         # exact value provided.
-        stop = self.stop()
+        start, stop, npts = self._get_sweep_settings()
+        if val <= start:
+            raise ValueError("Stop frequency must be larger than start "
+                             "frequency.")
         if abs(val - stop) >= 1:
             log.warning(
                 "Could not set stop to {} setting it to "
                 "{}".format(val, stop)
             )
-        self.update_lin_traces()
+        self._update_lin_traces(start, stop, npts)
 
     def _set_npts(self, val: int) -> None:
         self.write(f"SENS{self._ch}:SWE:POIN {val:.7f}")
+        if self._queued_writes is not None:
+            return
         self.update_lin_traces()
         self.update_cw_traces()
 
     def _set_bandwidth(self, val: int) -> None:
         self.write(f"SENS{self._ch}:BAND {val:.4f}")
+        if self._queued_writes is not None:
+            return
         self.update_cw_traces()
 
     def _set_span(self, val: float) -> None:
         self.write(f"SENS{self._ch}:FREQ:SPAN {val:.7f}")
+        if self._queued_writes is not None:
+            self._requested_sweep.pop("start", None)
+            self._requested_sweep.pop("stop", None)
+            return
         self.update_lin_traces()
 
     def _set_center(self, val: float) -> None:
         self.write(f"SENS{self._ch}:FREQ:CENT {val:.7f}")
+        if self._queued_writes is not None:
+            self._requested_sweep.pop("start", None)
+            self._requested_sweep.pop("stop", None)
+            return
         self.update_lin_traces()
 
     def _set_sweep_type(self, val: str) -> None:
@@ -701,9 +913,26 @@ class ZNBTrace(InstrumentChannel):
         Updates start, stop and npts of all trace parameters
         so that the x-coordinates are updated for the sweep.
         """
-        start = self.start()
-        stop = self.stop()
-        npts = self.npts()
+        self._update_lin_traces(*self._get_sweep_settings())
+
+    def _get_sweep_settings(self) -> Tuple[float, float, int]:
+        """
+        Queries start, stop and npts in a single message, and updates the
+        start, stop, center, span and npts parameter caches.
+        """
+        reply = self.ask(
+            f"SENS{self._ch}:FREQ:STAR?;STOP?;:SENS{self._ch}:SWE:POIN?"
+        )
+        start_str, stop_str, npts_str = reply.strip().split(";")
+        start, stop, npts = float(start_str), float(stop_str), int(npts_str)
+        self.start.cache.set(start)
+        self.stop.cache.set(stop)
+        self.center.cache.set((start + stop) / 2)
+        self.span.cache.set(stop - start)
+        self.npts.cache.set(npts)
+        return start, stop, npts
+
+    def _update_lin_traces(self, start: float, stop: float, npts: int) -> None:
         for _, parameter in self.parameters.items():
             if isinstance(parameter, (FrequencySweep, FrequencySweepMagPhase)):
                 try:
@@ -711,6 +940,79 @@ class ZNBTrace(InstrumentChannel):
                 except AttributeError:
                     pass
 
+    def write(self, cmd: str) -> None:
+        if self._queued_writes is not None:
+            self._queued_writes.append(cmd)
+        else:
+            super().write(cmd)
+
+    def ask(self, cmd: str) -> str:
+        if self._queued_writes:
+            self._flush_queued_writes()
+        return super().ask(cmd)
+
+    def _ask_data(self, cmd: str) -> np.ndarray:
+        if self._queued_writes:
+            self._flush_queued_writes()
+        return self.root_instrument._ask_data(cmd)
+
+    def _flush_queued_writes(self) -> None:
+        cmds = self._queued_writes
+        self._queued_writes = []
+        if cmds:
+            super().write(";:".join(cmds))
+
+    @contextmanager
+    def configure(self):
+        """
+        Context in which all writes of this trace are queued and sent as a
+        single message on exit, e.g.
+
+            with trace.configure():
+                trace.center(5e9)
+                trace.span(10e6)
+                trace.npts(1001)
+                trace.bandwidth(100)
+
+        Inside the context, setters do not read back the instrument. The
+        parameter caches hold the set values; on exit, start, stop and
+        npts are read back once, validated, and the trace setpoints and
+        caches are updated. If an exception is raised inside the context,
+        the queued writes are dropped and the caches of the parameters
+        set inside it are invalidated.
+        """
+        if self._queued_writes is not None:
+            # already configuring, the outer context sends the writes
+            yield self
+            return
+        self._queued_writes = []
+        self._requested_sweep = {}
+        t_enter = datetime.now()
+        try:
+            yield self
+            self._flush_queued_writes()
+        except BaseException:
+            for parameter in self.parameters.values():
+                timestamp = parameter.cache.timestamp
+                if timestamp is not None and timestamp >= t_enter:
+                    parameter.cache.invalidate()
+            raise
+        finally:
+            self._queued_writes = None
+        start, stop, npts = self._get_sweep_settings()
+        if start >= stop:
+            raise ValueError("Stop frequency must be larger than start "
+                             "frequency.")
+        for name, actual in [("start", start), ("stop", stop)]:
+            requested = self._requested_sweep.get(name)
+            if requested is not None and abs(requested - actual) >= 1:
+                log.warning(
+                    f"Could not set {name} to {requested} setting it to "
+                    f"{actual}"
+                )
+        self._update_lin_traces(start, stop, npts)
+        self.update_cw_traces()
+
     def update_cw_traces(self) -> None:
         """
         Updates the bandwidth and npts of all fixed frequency (CW) traces.
@@ -742,6 +1044,21 @@ class ZNBTrace(InstrumentChannel):
     
     def init_single(self):
         self.write(f"INIT{self._ch}:IMM")
+
+    def sweep_async(self, poll_interval: float = 0.1) -> ZNBSweepFuture:
+        """
+        Starts avg() sweeps of this channel with a single trigger, without
+        blocking, see ZNBSweepFuture. Call start_sweep first to clear the
+        averages.
+        """
+        n_avg = self.avg()
+        self.sweep_count(n_avg)
+        return ZNBSweepFuture(
+            self.root_instrument,
+            f"INIT{self._ch}:IMM",
+            poll_interval=poll_interval,
+            timeout=self.sweep_time() * n_avg + self._additional_wait,
+        )
         
 
     def _get_sweep_data(self, force_polar: bool = False, update: bool = True) -> np.ndarray:
@@ -758,25 +1075,21 @@ class ZNBTrace(InstrumentChannel):
             data_format_command = "SDAT"
         else:
             data_format_command = "FDAT"
-        timeout = self.sweep_time() + self._additional_wait
-        with self.root_instrument.timeout.set_to(timeout):
-            # instrument averages over its last 'avg' number of sweeps
-            # need to ensure averaged result is returned
-            if update:
-                print(f'taking {self.avg():d} averages')
-                for i in range(self.avg()):
-                    self.write(f"INIT{self._ch}:IMM; *WAI")
-                    if i>0: print(i, end=' ')
-
-            self.write(
-                f"CALC{self._ch}:PAR:SEL "
-                f"'{self._tracename}'"
-            )
-            data_str = self.ask(
-                f"CALC{self._ch}:DATA?"
-                f" {data_format_command}"
-            )
-        data = np.array(data_str.rstrip().split(",")).astype("float64")
+        # instrument averages over its last 'avg' number of sweeps
+        # need to ensure averaged result is returned. Completion is
+        # polled, so the VISA timeout need not cover the sweep time.
+        if update:
+            print(f'taking {self.avg():d} averages')
+            self.sweep_async().wait()
+
+        self.write(
+            f"CALC{self._ch}:PAR:SEL "
+            f"'{self._tracename}'"
+        )
+        data = self._ask_data(
+            f"CALC{self._ch}:DATA?"
+            f" {data_format_command}"
+        )
         # if self.format() in ["Polar",
         #                      "Complex",
         #                      "Smith",
@@ -799,6 +1112,8 @@ class ZNBTrace(InstrumentChannel):
         self.sweep_type("CW_Point")
         # turn off average on the VNA since we want single point sweeps.
         self.averaging_enabled(False)
+        # a trigger takes a single sweep, also if averages were taken before
+        self.sweep_count(1)
         # This format is required for getting both real and imaginary parts.
         self.format("Complex")
         # Set the sweep time to auto such that it sets the delay to zero
@@ -819,6 +1134,65 @@ class ZNBTrace(InstrumentChannel):
         self.averaging_enabled(True)
         self.root_instrument.cont_meas_on()
 
+    def set_segments(self, segments: Sequence[Dict[str, float]]) -> None:
+        """
+        Replaces the segment table of the channel. Each segment is a dict
+        with keys 'start', 'stop' (Hz) and 'npts', and optionally
+        'bandwidth' (Hz) and 'power' (dBm); if these are not given, the
+        channel settings are used. Use setup_segmented_sweep to also switch
+        to the segmented sweep type. The total number of points of all
+        segments is limited to MAX_SWEEP_POINTS.
+        """
+        total_npts = sum(int(segment["npts"]) for segment in segments)
+        if total_npts > self.MAX_SWEEP_POINTS:
+            raise ValueError(
+                f"The segments have {total_npts} points in total, the "
+                f"maximum of a sweep is {self.MAX_SWEEP_POINTS}"
+            )
+        cmds = [f"SENS{self._ch}:SEGM:DEL:ALL"]
+        for k, segment in enumerate(segments, start=1):
+            seg = f"SENS{self._ch}:SEGM{k}"
+            cmds.append(f"{seg}:ADD")
+            cmds.append(f"{seg}:FREQ:STAR {segment['start']:.7f}")
+            cmds.append(f"{seg}:FREQ:STOP {segment['stop']:.7f}")
+            cmds.append(f"{seg}:SWE:POIN {int(segment['npts']):d}")
+            if "bandwidth" in segment:
+                cmds.append(f"{seg}:BWID {segment['bandwidth']:.4f}")
+            if "power" in segment:
+                cmds.append(f"{seg}:POW {segment['power']:.4f}")
+        self.write(";:".join(cmds))
+        self._segments = [dict(segment) for segment in segments]
+
+    def setup_segmented_sweep(self, segments: Sequence[Dict[str, float]]) -> None:
+        """
+        Sets the segment table (see set_segments) and switches the channel
+        to segmented sweep mode, so that a single sweep covers all
+        segments. Use setup_lin_sweep to go back to linear sweeps.
+        """
+        self.set_segments(segments)
+        self.sweep_type("Segmented")
+
+    def segment_frequencies(self) -> List[np.ndarray]:
+        """
+        Returns the frequency points of each segment of the segment table.
+        """
+        return [
+            np.linspace(segment["start"], segment["stop"], int(segment["npts"]))
+            for segment in self._segments
+        ]
+
+    def split_segments(self, data: np.ndarray) -> List[np.ndarray]:
+        """
+        Splits the data of a segmented sweep into the data of each segment.
+        """
+        npts = [int(segment["npts"]) for segment in self._segments]
+        if len(data) != sum(npts):
+            raise RuntimeError(
+                f"Got {len(data)} points, but the segment table has "
+                f"{sum(npts)} points. Was it changed on the instrument?"
+            )
+        return np.split(data, np.cumsum(npts)[:-1])
+
     def _check_cw_sweep(self) -> None:
         """
         Checks if all required settings are met to be able to measure in
@@ -845,6 +1219,7 @@ class ZNBTrace(InstrumentChannel):
 
         # Turn off average on the VNA since we want single point sweeps.
         self.averaging_enabled(False)
+        self.sweep_count(1)
         # Set the format to complex.
         self.format("Complex")
         # Set cont measurement off.
@@ -862,14 +1237,24 @@ class ZNBTrace(InstrumentChannel):
             timeout = self.sweep_time.cache.get() + self._additional_wait
             with self.root_instrument.timeout.set_to(timeout):
                 self.write(f"INIT{self._ch}:IMM; *WAI")
-                data_str = self.ask(f"CALC{self._ch}:DATA? "
-                                    f"SDAT")
-            data = np.array(data_str.rstrip().split(",")).astype("float64")
-            i = data[0::2]
-            q = data[1::2]
+                i, q = self._read_cw_data()
 
         return i, q
 
+    def _read_cw_data(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the I and Q data of the last CW sweep, without triggering.
+        """
+        data = self._ask_data(f"CALC{self._ch}:DATA? SDAT")
+        return data[0::2], data[1::2]
+
+    def cw_stream(self, *traces: "ZNBTrace", **kwargs: Any) -> "ZNBCWStream":
+        """
+        Returns a ZNBCWStream of this trace, double-buffered with the
+        given traces on other channels, see ZNBCWStream.
+        """
+        return ZNBCWStream((self,) + traces, **kwargs)
+
 
 class ZNB(VisaInstrument):
     """
@@ -949,6 +1334,18 @@ class ZNB(VisaInstrument):
             val_mapping  = {True: "1\n", False: "0\n"},
         )
         
+        self.add_parameter(
+            name="binary_data_transfer",
+            initial_value=True,
+            get_cmd=None,
+            set_cmd=self._set_binary_data_transfer,
+            vals=vals.Bool(),
+            docstring="If True, trace data is transferred as binary "
+            "REAL,64 blocks with swapped (little endian) byte "
+            "order, otherwise as ASCII. Binary transfer is "
+            "about 3 times less data and needs no string parsing.",
+        )
+        
         def parse_esr_opc(val):
             val_int = int(val)
             opc_bit_set = bool(val_int & 1)
@@ -960,7 +1357,6 @@ class ZNB(VisaInstrument):
             get_parser = parse_esr_opc,
         )
 
-        self.add_function("reset", call_cmd="*RST")
         self.add_function("tooltip_on", call_cmd="SYST:ERR:DISP ON")
         self.add_function("tooltip_off", call_cmd="SYST:ERR:DISP OFF")
         self.add_function("update_display_once", call_cmd="SYST:DISP:UPD ONCE")
@@ -1010,6 +1406,89 @@ class ZNB(VisaInstrument):
         self.update_display_on()
         self.connect_message()
 
+    def reset(self) -> None:
+        """
+        Resets the instrument with *RST. The reset also sets the data
+        format back to ASCII, so the format of binary_data_transfer is
+        sent again.
+        """
+        self.write("*RST")
+        self._set_binary_data_transfer(self.binary_data_transfer.cache.get())
+
+    def _set_binary_data_transfer(self, val: bool) -> None:
+        if val:
+            self.write("FORM REAL,64;FORM:BORD SWAP")
+        else:
+            self.write("FORM ASC")
+
+    def _ask_data(self, cmd: str) -> np.ndarray:
+        """
+        Queries trace data in the format set by binary_data_transfer, and
+        returns it as a float64 array.
+        """
+        if self.binary_data_transfer.cache.get():
+            # the visa library decodes the IEEE 488.2 block with np.frombuffer
+            return self.visa_handle.query_binary_values(
+                cmd, datatype="d", is_big_endian=False, container=np.array
+            )
+        data_str = self.ask(cmd)
+        return np.array(data_str.rstrip().split(",")).astype("float64")
+
+    def get_traces_per_channel(self) -> Dict[int, List[ZNBTrace]]:
+        traces_per_channel: Dict[int, List[ZNBTrace]] = {}
+        for trace in self.traces:
+            traces_per_channel.setdefault(trace._ch, []).append(trace)
+        return traces_per_channel
+
+    def sweep_all_channels(
+        self, blocking: bool = True, poll_interval: float = 0.1
+    ) -> Optional[ZNBSweepFuture]:
+        """
+        Takes the averages of all channels with a single INIT:ALL, instead
+        of triggering each channel separately. If blocking is False,
+        returns a ZNBSweepFuture instead of waiting for the sweeps.
+        """
+        traces_per_channel = self.get_traces_per_channel()
+        duration = 0.0
+        for traces in traces_per_channel.values():
+            for trace in traces:
+                trace.start_sweep()
+            # each channel takes its own number of averages
+            n_avg = traces[0].avg()
+            traces[0].sweep_count(n_avg)
+            duration += traces[0].sweep_time() * n_avg
+        additional_wait = max(traces[0]._additional_wait for traces in traces_per_channel.values())
+        future = ZNBSweepFuture(
+            self, "INIT:ALL", poll_interval=poll_interval,
+            timeout=duration + additional_wait,
+        )
+        if not blocking:
+            return future
+        future.wait()
+        return None
+
+    def get_all_sweep_data(self, update: bool = True) -> Dict[str, np.ndarray]:
+        """
+        Reads the complex (SDAT) data of all traces, with a single
+        CALC<Ch>:DATA:CHAN:DALL? query per channel. If update is True, all
+        channels are first swept at once, see sweep_all_channels.
+
+        Returns a dict of complex arrays, with the trace short names as keys.
+        """
+        if update:
+            self.sweep_all_channels()
+        data = {}
+        for ch, traces in self.get_traces_per_channel().items():
+            # the traces are returned in the order of the channel catalog
+            catalog = self.ask(f"CALC{ch}:PAR:CAT?").strip().strip("'").split(",")
+            tracenames = catalog[0::2]
+            ch_data = self._ask_data(f"CALC{ch}:DATA:CHAN:DALL? SDAT")
+            ch_data = ch_data.reshape((len(tracenames), -1, 2))
+            for trace in traces:
+                trace_data = ch_data[tracenames.index(trace._tracename)]
+                data[trace.short_name] = trace_data[:, 0] + 1j * trace_data[:, 1]
+        return data
+
     def display_grid(self, rows: int, cols: int) -> None:
         """
         Display a grid of channels rows by columns.
@@ -21,7 +21,8 @@ import time
 import logging
 import numpy as np
 
-lib import zi_measurement
+from lib import zi_measurement
+from lib.parameter_sweep import ParameterSweep
 import config
 data_folder = config.get('data_folder')
 
@@ -40,7 +41,10 @@ params['do_plot'] = True
 params['check_scope_record_flags'] = True
 params['scope_fft_mode'] = False  # True
 params['scope_averager_weigth'] = 0
-params['scope_history_length'] = 1
+params['scope_history_length'] = 1  # must hold all records that arrive per scope_read_interval, otherwise records are dropped
+params['scope_records'] = 1  # records are appended to the 'traces' dataset as they arrive, can be more than scope_history_length
+params['scope_read_interval'] = 0.3  # s
+params['scope_segments'] = 1  # >1 for segmented mode, requires the DIG option
 params['scope_averager_method'] = 0
 params['fft_window'] = 0
 
@@ -50,6 +54,22 @@ print('Running meas')
 meas.run()
 meas.finish()
 
+# %% Continuous demodulator data streaming
+name = 'demod_stream'
+
+params = {}
+params['do_plot'] = True
+params['duration'] = 60  # s
+params['poll_time'] = 0.1  # s
+params['save_data_keys'] = ['timestamp', 'x', 'y', 'r', 'phase']
+params['sample_nodes'] = [device.demods[0].sample.zi_node]
+
+meas = zi_measurement.ZIDAQMeasurement(name, device, params=params, base_folder=data_folder)
+
+print('Running daq meas')
+meas.run(run_identifier=str(0))
+meas.finish()
+
 # %% Sweeper measurement
 params = {}
 params['do_plot'] = True
@@ -140,9 +160,8 @@ print('Running sweeper meas')
 drop_change = 0.2  # The ratio between std of measured signal and std of signal when magnet is levitated
 max_change = 1.5  # The max ratio between std of measured signal and std of signal when magnet is levitated
 
-for j, parameter in enumerate(params['sweep_parameter']):
-    if j > 0:
-        meas.params['autoscale_plot'] = False
+def set_parameter(parameter):
+    meas.params['autoscale_plot'] = parameter == params['sweep_parameter'][0]
 
     # Frequency sweep
     # frequency = parameter
@@ -175,7 +194,9 @@ for j, parameter in enumerate(params['sweep_parameter']):
     # B0-field sweep
     #ramp_tenma(parameter)
 
-    meas.run(run_identifier=str(j), setup=False, run_params={'parameter': parameter})
+
+sweep = ParameterSweep(meas, [('parameter', set_parameter, params['sweep_parameter'])])
+sweep.run(setup=False)
 
 meas.finish()
 
@@ -84,17 +84,18 @@ name = 'q_meas'
 # turn_on_coherent_drive()
 
 def callback(frame_count):
-    if frame_count>frame_count_update: 
+    if frame_count>=frame_count_update: 
         #turn_off_coherent_drive()
         return 0.      
     return 1.
 
 m = camera_measurement.CameraMeasurement(name, cam,  params=params, base_folder=data_folder)
 m.setup()
-m.run(run_identifier=str(0),run_params={},update_callback=callback)
+# the callback runs on a separate thread, only when the frame count crosses a multiple of update_callback_frames
+m.run(run_identifier=str(0),run_params={},update_callback=callback, update_callback_frames=frame_count_update)
 m.finish()
 
-# %% frequency sweep - works for typical framerates less than 100 Hz
+# %% frequency sweep - the callback runs on a separate thread, so a slow function generator does not limit the framerate
 
 data_folder = config.get('data_folder')
 
@@ -118,14 +119,14 @@ name = 'freq_sweep'
 def callback(frame_count):
     step = min([int(np.floor(frame_count/frame_count_update)),pts-1])
     f = freqs[step]
-    if frame_count%frame_count_update ==0 and step<pts: 
-        print(step, f)
-        #change_function_generator_frequency()
+    print(step, f)
+    #change_function_generator_frequency()
     return f
 
 
 m = camera_measurement.CameraMeasurement(name, cam,  params=params, base_folder=data_folder)
 m.setup()
-m.run(run_identifier=str(0),run_params={},update_callback=callback)
+m.run(run_identifier=str(0),run_params={},update_callback=callback, update_callback_frames=frame_count_update)
+# the frame count at which each frequency took effect is saved in 'aux_update_frame_counter' and 'aux_update_value'
 m.finish()
 
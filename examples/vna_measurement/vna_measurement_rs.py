@@ -18,7 +18,8 @@ import time
 from qcodes import Instrument
 
 from drivers import ZNB
-from lib.vna_measurement_rs import VNAMeasurement, VNACurrentMeasurement
+from lib.vna_measurement_rs import VNAMeasurement, VNASegmentedMeasurement, VNACWStreamMeasurement, VNACurrentMeasurement
+from lib.parameter_sweep import ParameterSweep
 import config
 data_folder = config.get('data_folder')
 
@@ -136,6 +137,31 @@ for i,cf in enumerate(params['center_frequencies']):
 meas.finish()    
 #############################################################
 
+# %% stepped scans in a single segmented sweep, saved with the same layout as the stepped scans above
+name = '18mK_0_5_GHz_range_segmented'
+params = {}
+
+params['device'] = ''   
+params['center_frequencies'] = np.arange(0.5e9, 5e9+1e8, 1e8)
+span = 1e8
+# all segments together are limited to 100001 points, here 46 segments of 2000 points
+freq_stepsize = 50e3
+trace = vna.traces[0]
+trace.bandwidth(100)
+trace.avg(1)
+trace.power(5)
+# adjacent segments should not share their edge frequency
+segments = [{'start': cf-span/2, 'stop': cf+span/2-freq_stepsize, 'npts': int(span/freq_stepsize)} for cf in params['center_frequencies']]
+trace.setup_segmented_sweep(segments)
+
+meas = VNASegmentedMeasurement(name, vna, params=params, base_folder = data_folder)
+meas.setup()
+meas.run()   # run groups '0', '1', ..., one per segment
+meas.finish()
+
+trace.setup_lin_sweep()
+#############################################################
+
 # %% Zoom in on resonances
 name = 'zooms'
 params = {}
@@ -163,6 +189,31 @@ for i,cf in enumerate(params['center_frequencies']):
     
 meas.finish() 
 #############################################################   
+
+# %% CW time trace streaming, double buffered on two channels
+name = 'cw_stream'
+params = {}
+
+params['device'] = ''
+params['duration'] = 600 #s
+
+vna.add_trace('S21_cw2', 2, vna_parameter='S21')  # second channel, sweeps while the first one is read out
+cw_traces = [vna.traces[0], vna.traces[-1]]
+for trace in cw_traces:
+    trace.setup_cw_sweep()
+    trace.cw_frequency(5.5e9)
+    trace.npts(10000)
+    trace.bandwidth(1e4)
+    trace.power(-30)
+    trace.update_cw_traces()
+
+meas = VNACWStreamMeasurement(name, vna, params=params, base_folder = data_folder)
+meas.run(traces=cw_traces)
+meas.finish()
+
+for trace in cw_traces:
+    trace.setup_lin_sweep()
+#############################################################   
     
 # %% Power sweep
 name = 'power_sweep'
@@ -180,17 +231,20 @@ trace.npts(100001)
 trace.bandwidth(1e2)
 trace.avg(1)
 
-meas = VNAMeasurement(name,vna, params=params, base_folder = data_folder)
-meas.setup()
-
-for j,p in enumerate(params['powers']):
-    trace.power.set(p)
-    for i,cf in enumerate(params['center_frequencies']):
-        #meas.run(run_identifier=str(0),run_params={})
-        trace.center.set(cf)
-        meas.run(run_identifier=f'{i}_{j}',setup=False,run_params={'center_frequency':cf, 'power':p}) # 
-
-meas.finish()    
+# To continue an interrupted sweep, skipping the completed points, set resume_filepath to the file of that sweep,
+# or to 'latest' for the latest power_sweep file. Check that its params match: the new points are appended to it,
+# and if all points were completed nothing is measured.
+# The with statement closes the file also when the sweep is interrupted.
+resume_filepath = None  # 'latest'
+with VNAMeasurement(name,vna, params=params, base_folder = data_folder, resume_filepath=resume_filepath) as meas:
+    meas.setup()
+
+    # run_identifiers are f'{i}_{j}', i the center frequency index and j the power index.
+    # the next setpoint is set while the previous trace is being plotted and saved.
+    sweep = ParameterSweep(meas, [('power', trace.power.set, params['powers']),
+                                  ('center_frequency', trace.center.set, params['center_frequencies'])],
+                           run_identifier_dims=[1,0])
+    sweep.run(setup=False)
 #############################################################   
 
 # %% Current sweep
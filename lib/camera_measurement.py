@@ -12,6 +12,7 @@ All rights reserved.
 """
 
 import time
+import threading
 import numpy as np
 import pyqtgraph as pg
 import logging
@@ -45,16 +46,83 @@ class CameraMeasurement(Measurement):
         cur_aux_data = run_h5_group.create_dataset(f'aux_data-{dataset_idx:d}',(cur_dset_size,),dtype=np.float64)
         return cur_frame_image_data, cur_frame_timestamp_data, cur_frame_count_data, cur_aux_data
 
-    def run(self, setup=True, run_identifier=None, update_callback=None, run_params={}):
+    def start_update_callback_thread(self, update_callback, update_callback_frames=1, update_callback_interval=None):
+        """
+        Start a control thread that calls update_callback(frame_count), so slow instruments in the callback 
+        do not stall the frame draining in run. The callback is called once the latest frame count 
+        crosses the next multiple of update_callback_frames, and/or when update_callback_interval seconds 
+        have passed since the previous call (set either to None to disable that trigger).
+        The callback is first called once synchronously with frame_count 0, so the frames stored 
+        before the first threaded call returns are labelled with that value.
+        """
+        value = update_callback(0)
+        self._latest_frame_count = -1
+        self._aux_value = value
+        self._aux_updates = [(0, 0, value)]
+        self._update_callback_exception = None
+        # held while swapping the aux value and reading the frame count, and while reading a frame's aux value
+        # and advancing the frame count, so the frame from which a new value takes effect is recorded exactly
+        self._aux_lock = threading.Lock()
+        self._new_frame = threading.Event()
+        self._update_callback_running = threading.Event()
+        self._update_callback_running.set()
+        self._update_callback_thread = threading.Thread(target=self._run_update_callback, 
+                                                        args=(update_callback, update_callback_frames, update_callback_interval))
+        self._update_callback_thread.start()
+
+    def stop_update_callback_thread(self):
+        self._update_callback_running.clear()
+        self._new_frame.set()
+        self._update_callback_thread.join()
+        if self._update_callback_exception is not None:
+            raise self._update_callback_exception
+
+    def _run_update_callback(self, update_callback, update_callback_frames, update_callback_interval):
+        next_frame_count = update_callback_frames if update_callback_frames is not None else 0
+        next_time = time.time() + (update_callback_interval if update_callback_interval is not None else 0)
+        while self._update_callback_running.is_set():
+            self._new_frame.wait(timeout=0.01)
+            self._new_frame.clear()
+            frame_count = self._latest_frame_count
+            if frame_count < 0:
+                continue
+            frames_due = update_callback_frames is not None and frame_count >= next_frame_count
+            time_due = update_callback_interval is not None and time.time() >= next_time
+            if not(frames_due or time_due):
+                continue
+            try:
+                value = update_callback(frame_count)
+            except Exception as e:
+                self._update_callback_exception = e
+                self._update_callback_running.clear()
+                break
+            # the new value is in effect from the next frame onwards
+            with self._aux_lock:
+                self._aux_value = value
+                self._aux_updates.append((frame_count, self._latest_frame_count+1, value))
+            if update_callback_frames is not None:
+                next_frame_count = (frame_count//update_callback_frames + 1)*update_callback_frames
+            if update_callback_interval is not None:
+                next_time = time.time() + update_callback_interval
+
+    def save_aux_updates(self, run_h5_group):
+        aux_updates = np.array(self._aux_updates, dtype=np.float64).reshape((-1,3))
+        run_h5_group.create_dataset('aux_update_callback_frame_counter', data = aux_updates[:,0].astype(np.int64))
+        run_h5_group.create_dataset('aux_update_frame_counter', data = aux_updates[:,1].astype(np.int64))
+        run_h5_group.create_dataset('aux_update_value', data = aux_updates[:,2])
+
+    def run(self, setup=True, run_identifier=None, update_callback=None, run_params={}, 
+            update_callback_frames=1, update_callback_interval=None):
+        """
+        update_callback(frame_count) is executed on a separate control thread, see start_update_callback_thread.
+        For each frame, aux_data holds the callback value that was in effect when the frame was stored, 
+        the aux_update_* datasets hold the frame count from which each callback value took effect.
+        """
         
         if setup:
             self.setup()
             
-        if run_identifier is not None:
-            run_h5_group = self.h5data.create_group('{}'.format(run_identifier))
-            self.save_dict(run_params,run_h5_group.name+'/')
-        else:
-            run_h5_group = self.h5data
+        run_h5_group = self.create_run_group(run_identifier, run_params)
         
         frame_idx = 0
         dataset_frame_idx = 0
@@ -63,8 +131,16 @@ class CameraMeasurement(Measurement):
         cur_dset_size = min([MAX_FRAMES_PER_DATASET, self.params['max_frames']])
         cur_frame_image_data, cur_frame_timestamp_data, cur_frame_count_data, cur_aux_data = self.create_datasets(run_h5_group, dataset_idx, cur_dset_size)
                 
-        self.camera.arm(self.params['frames_to_buffer'] )
-        self.camera.issue_software_trigger()
+        if update_callback is not None:
+            self.start_update_callback_thread(update_callback, update_callback_frames, update_callback_interval)
+        
+        try:
+            self.camera.arm(self.params['frames_to_buffer'] )
+            self.camera.issue_software_trigger()
+        except:
+            if update_callback is not None:
+                self.stop_update_callback_thread()
+            raise
         
         try:
             t0 = time.time()
@@ -76,6 +152,12 @@ class CameraMeasurement(Measurement):
                     cur_frame_image_data[:,:,dataset_frame_idx] = frame.image_buffer
                     cur_frame_timestamp_data[dataset_frame_idx] = frame.time_stamp_relative_ns_or_null
                     cur_frame_count_data[dataset_frame_idx] = frame.frame_count
+                    if update_callback is not None:
+                        with self._aux_lock:
+                            aux_value = self._aux_value
+                            self._latest_frame_count = frame.frame_count
+                        cur_aux_data[dataset_frame_idx] = aux_value
+                        self._new_frame.set()
                     
                     if self.params['do_plot'] and frame_idx % self.params['plot_update_frames'] ==0:
                         if frame_idx ==0:
@@ -87,15 +169,14 @@ class CameraMeasurement(Measurement):
                     if frame_idx % 100 ==0 and frame_idx>0:
                         print('\r', f'{frame_idx/self.params["max_frames"]*100:.0f}%', end='')
                         self.h5data.flush()
-                    if update_callback is not None:
-                        cur_aux_data[dataset_frame_idx] = update_callback(cur_frame_count_data[dataset_frame_idx])
                     # self.h5data.flush()
                     frame_idx += 1
                     dataset_frame_idx += 1
                 
                 if (frame_idx >= self.params['max_frames']) or\
                         (time.time()-t0 >= self.params['max_duration']) or\
-                            (self.params['do_plot'] and not(self.p.isVisible())):
+                            (self.params['do_plot'] and not(self.p.isVisible())) or\
+                                (update_callback is not None and not(self._update_callback_running.is_set())):
                     break
                     
                 if dataset_frame_idx >= MAX_FRAMES_PER_DATASET:
@@ -105,6 +186,7 @@ class CameraMeasurement(Measurement):
                     cur_frame_image_data, cur_frame_timestamp_data, cur_frame_count_data, cur_aux_data = self.create_datasets(run_h5_group, dataset_idx, cur_dset_size)
                     
                 
+            self.acquisition_finished()
             print('Measurment finished')
             print(f'Percentage dropped frames: {(1-((frame_idx-1)/(cur_frame_count_data[dataset_frame_idx-1]-1)))*100:.2f}')
             
@@ -114,6 +196,11 @@ class CameraMeasurement(Measurement):
                 
         finally:        
             self.camera.disarm()
+            if update_callback is not None:
+                try:
+                    self.stop_update_callback_thread()
+                finally:
+                    self.save_aux_updates(run_h5_group)
             self.h5data.flush()
             
             
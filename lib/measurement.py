@@ -25,12 +25,13 @@ also be facilitated by an OO approach like this one.
 
 ### imports
 import sys,os,time,shutil,inspect
-from stat import S_IREAD, S_IRGRP, S_IROTH
+from stat import S_IREAD, S_IWRITE, S_IRGRP, S_IROTH
 import logging
 import numpy as np
 import h5py
 
 from .io import naming, hdf5_data_tools, tools
+from analysis import data_tools
 
 class Measurement:
     """
@@ -40,11 +41,23 @@ class Measurement:
        
     STACK_DIR = 'stack'
     FILES_DIR = 'files'
+    COMPLETED_RUNS_DSET = data_tools.COMPLETED_RUNS_DSET
+    RUN_INDEX_DSET = data_tools.RUN_INDEX_DSET
 
-    def __init__(self, name, params=None,  save=True, cached=False, **kwargs):
+    def __init__(self, name, params=None,  save=True, cached=False, resume_filepath=None, **kwargs):
+        '''
+        resume_filepath: path of an existing measurement file to append to, instead of creating a new one.
+        Runs that were marked completed in that file can then be skipped, see is_run_completed.
+        If 'latest', the latest file of a measurement with the same name is resumed, or a new file 
+        is created if there is none.
+        '''
         self.name = name
         self.cached = cached
         self.params = {}
+        self.acquisition_finished_callback = None
+        self.completed_run_identifiers = set()
+        self.run_identifiers = set()
+        self._session_run_identifiers = set()
 
         if params!=None:
             for k,v in params.items():
@@ -52,13 +65,21 @@ class Measurement:
         
         if save:
             self.dataset_idx = 0
-            self.h5datapath = naming.MeasurementFilepathGenerator(**kwargs).generate(name)
+            if resume_filepath == 'latest':
+                resume_filepath = self.get_latest_filepath(**kwargs)
+            if resume_filepath is None:
+                self.h5datapath = naming.MeasurementFilepathGenerator(**kwargs).generate(name)
+                file_mode = 'w'
+            else:
+                self.h5datapath = resume_filepath
+                os.chmod(self.h5datapath, S_IREAD|S_IWRITE|S_IRGRP|S_IROTH) #finish made the file read only
+                file_mode = 'a'
             self.datafolder,self.filename = os.path.split(self.h5datapath)
             self.f_id = int(self.filename.split(naming.SEP)[0])
             if not os.path.isdir(self.datafolder):
                 os.makedirs(self.datafolder)
             
-            self.h5data = h5py.File(self.h5datapath, 'w', libver='latest')
+            self.h5data = h5py.File(self.h5datapath, file_mode, libver='latest')
             self.h5base = '/'
             self.h5data.attrs['name'] = self.name
             
@@ -69,12 +90,25 @@ class Measurement:
                 self.cache_datapath = os.path.join(local_cache_folder,self.filename)
                 self.h5data.attrs['cached_filepath'] = self.cache_datapath
                 self.h5data.close()
-                self.h5data = h5py.File(self.cache_datapath, 'w', libver='latest')
+                if resume_filepath is not None:
+                    shutil.copy(self.h5datapath, self.cache_datapath)
+                self.h5data = h5py.File(self.cache_datapath, file_mode, libver='latest')
                 
                 self.h5base = '/'
                 self.h5data.attrs['name'] = self.name
             
-            self.save_params('params/')
+            if resume_filepath is None:
+                self.save_params('params/')
+            else:
+                if self.COMPLETED_RUNS_DSET in self.h5data:
+                    self.completed_run_identifiers = set(self.h5data[self.COMPLETED_RUNS_DSET].asstr()[:])
+                if self.RUN_INDEX_DSET in self.h5data:
+                    self.run_identifiers = set(self.h5data[self.RUN_INDEX_DSET].asstr()[:])
+                else:
+                    self.backfill_run_index()
+                resume_idx = len([k for k in self.h5data.keys() if k.startswith('params-resume')])
+                self.save_params(f'params-resume-{resume_idx:d}/')
+                logging.info(f'{self.name}: resuming {self.h5datapath}, {len(self.completed_run_identifiers)} completed runs')
                 
             
             
@@ -86,9 +120,21 @@ class Measurement:
         return self
         
     def __exit__(self, type, value, traceback):
-        """ Method to allow the use of the with-as statement
+        """ Method to allow the use of the with-as statement.
+        Also closes the file if the measurement was interrupted, so it can be resumed.
         """
         self.finish()
+
+    def get_latest_filepath(self, base_folder=naming.BASE, **kwargs):
+        '''
+        Returns the filepath of the latest measurement in base_folder with the same name, or None.
+        '''
+        ids, fps = naming.latest(base_folder=base_folder, contains=self.name, return_all=True)
+        ids_fps = [(i,fp) for i,fp in zip(ids,fps) if naming.name_from_filepath(fp) == self.name]
+        if len(ids_fps) == 0:
+            logging.info(f'{self.name}: no measurement to resume found in {base_folder}, starting a new one')
+            return None
+        return max(ids_fps)[1]
         
     def get_filename(self):
         return self.filename
@@ -139,6 +185,73 @@ class Measurement:
         self.save_dict(self.params,params_base)
         self.h5data.flush()
 
+    def mark_run_completed(self, run_identifier):
+        '''
+        Records run_identifier as completed in the data file, so that a resumed measurement
+        (see resume_filepath) can skip it.
+        '''
+        run_identifier = str(run_identifier)
+        if run_identifier in self.completed_run_identifiers:
+            return
+        self._append_identifier(self.COMPLETED_RUNS_DSET, run_identifier)
+        self.completed_run_identifiers.add(run_identifier)
+        self.h5data.flush()
+
+    def _append_identifier(self, dset_name, run_identifier):
+        if dset_name in self.h5data:
+            ds = self.h5data[dset_name]
+            ds.resize(ds.shape[0]+1, axis=0)
+            ds[-1] = run_identifier
+        else:
+            self.h5data.create_dataset(dset_name, data=[run_identifier], 
+                                       maxshape=(None,), dtype=h5py.string_dtype())
+
+    def backfill_run_index(self):
+        '''
+        Writes the RUN_INDEX_DSET of a file written before it was introduced, from the groups in the file
+        other than the params and snapshot groups, so that resumed runs are added to a complete index.
+        '''
+        for k, v in self.h5data.items():
+            if isinstance(v, h5py.Group) and not(k.startswith('params') or k.endswith('snapshot')):
+                self._append_identifier(self.RUN_INDEX_DSET, k)
+                self.run_identifiers.add(k)
+        self.h5data.flush()
+
+    def is_run_completed(self, run_identifier):
+        return str(run_identifier) in self.completed_run_identifiers
+
+    def create_run_group(self, run_identifier, run_params={}):
+        '''
+        Creates the data group of a run and saves run_params in it, or returns the root group if 
+        run_identifier is None. A group left by an interrupted, uncompleted run of a previous 
+        session (see resume_filepath) is removed first.
+        The run_identifier is added to the RUN_INDEX_DSET dataset, so analysis can find the run groups
+        without iterating over the file, see analysis.data_tools.get_run_identifiers.
+        '''
+        if run_identifier is None:
+            return self.h5data
+        run_identifier = str(run_identifier)
+        if run_identifier in self.h5data:
+            if self.is_run_completed(run_identifier) or run_identifier in self._session_run_identifiers:
+                raise ValueError(f'Run {run_identifier} already exists')
+            logging.warning(f'{self.name}: removing data of uncompleted run {run_identifier}')
+            del self.h5data[run_identifier]
+        run_h5_group = self.h5data.create_group(run_identifier)
+        self.save_dict(run_params,run_h5_group.name+'/')
+        if run_identifier not in self.run_identifiers:
+            self._append_identifier(self.RUN_INDEX_DSET, run_identifier)
+            self.run_identifiers.add(run_identifier)
+        self._session_run_identifiers.add(run_identifier)
+        return run_h5_group
+
+    def acquisition_finished(self):
+        '''
+        To be called by measurements in run, once they are done with the instruments but before 
+        plotting and writing out the data. Allows e.g. a ParameterSweep to already move to the next setpoint.
+        '''
+        if self.acquisition_finished_callback is not None:
+            self.acquisition_finished_callback()
+
     def setup(self, save_params = False):
         if save_params:
             self.save_params('params-setup/')
@@ -152,6 +265,8 @@ class Measurement:
         '''
         Optionally saves params dictionary, cfg files, instrument settings and script stack, then closes the hd5 data object
         '''
+        if not self.h5data:
+            return #already finished
         if save_params:
             self.save_params('params-post/')
             
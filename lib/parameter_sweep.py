@@ -0,0 +1,140 @@
+"""
+Created 2026
+
+@author: B.J.Hensen
+
+This work is licensed under the GNU Affero General Public License v3.0
+
+Copyright (c) 2026, Hensen Lab
+
+All rights reserved.
+
+This module contains ParameterSweep, which runs a Measurement over an
+N-dimensional grid of outer parameters, replacing hand-written
+for-loops around Measurement.run.
+"""
+
+import time
+import itertools
+import threading
+import logging
+
+class ParameterSweep:
+    """
+    Runs measurement.run for every point of an N-dimensional grid of outer parameters.
+
+    For each point, the run_identifier is the '_'-joined grid indices (outermost parameter first,
+    e.g. '2_0', or in the order of run_identifier_dims), and the parameter values are saved as run_params. Setters are only called
+    for the parameters whose value changes.
+
+    If overlap is True, the setters for the next point are called on a background thread as soon as
+    the measurement signals it is done with its instruments (see Measurement.acquisition_finished),
+    so ramping and settling overlap with plotting and writing out the previous point. Measurements
+    that do not call acquisition_finished are not overlapped. Set overlap to False if the setters
+    share an instrument with anything that happens in measurement.run after acquisition_finished.
+
+    Completed points are recorded in the data file, so when the measurement is created with
+    resume_filepath, running the sweep again skips the points that were already measured.
+    """
+
+    def __init__(self, measurement, sweep_parameters, settle_time=0, overlap=True, get_run_params=None,
+                 run_identifier_dims=None):
+        """
+        sweep_parameters: list of tuples (name:str, set_func:function, values:array), outermost parameter first.
+        settle_time: time (s) to wait after setting a new point, before measuring it.
+        get_run_params: optional function returning a dict of additional run_params, called just before each run,
+                        e.g. to save a read-back value of a set parameter.
+        run_identifier_dims: order of the grid indices in the run_identifier, e.g. [1,0] for f'{i}_{j}' with 
+                             j the index of the outer and i of the inner parameter. Defaults to outermost first.
+        """
+        self.measurement = measurement
+        self.sweep_parameters = sweep_parameters
+        self.settle_time = settle_time
+        self.overlap = overlap
+        self.get_run_params = get_run_params
+        self.run_identifier_dims = run_identifier_dims if run_identifier_dims is not None else range(len(sweep_parameters))
+
+    def get_shape(self):
+        return tuple(len(values) for name, set_func, values in self.sweep_parameters)
+
+    def get_points(self):
+        """
+        returns a list of (run_identifier, idxs, values) for all points of the grid.
+        """
+        points = []
+        for idxs in itertools.product(*[range(n) for n in self.get_shape()]):
+            values = tuple(self.sweep_parameters[d][2][idx] for d,idx in enumerate(idxs))
+            points.append(('_'.join(str(idxs[d]) for d in self.run_identifier_dims), idxs, values))
+        return points
+
+    def set_point(self, prev_values, values):
+        for d,(name, set_func, _) in enumerate(self.sweep_parameters):
+            if prev_values is None or prev_values[d] != values[d]:
+                set_func(values[d])
+
+    def _set_point_in_background(self, prev_values, values):
+        try:
+            self.set_point(prev_values, values)
+        except Exception as e:
+            self._set_exception = e
+        self._set_finished_time = time.time()
+
+    def _start_set_thread(self, prev_values, values):
+        if self._set_thread is None:
+            self._set_thread = threading.Thread(target=self._set_point_in_background, args=(prev_values, values))
+            self._set_thread.start()
+
+    def _wait_for_set_thread(self):
+        self._set_thread.join()
+        self._set_thread = None
+        if self._set_exception is not None:
+            e = self._set_exception
+            self._set_exception = None
+            raise e
+        time.sleep(max(0, self.settle_time - (time.time() - self._set_finished_time)))
+
+    def run(self, resume=True, **run_kw):
+        """
+        Runs the sweep, run_kw are passed on to measurement.run (e.g. setup=False).
+        If resume is True, points that are already marked completed in the data file are skipped.
+        """
+        points = self.get_points()
+        if resume:
+            points = [p for p in points if not self.measurement.is_run_completed(p[0])]
+            n_skipped = len(self.get_points()) - len(points)
+            if n_skipped > 0:
+                logging.info(f'{self.measurement.name}: skipping {n_skipped} completed sweep points')
+        if len(points) == 0:
+            return
+
+        names = [name for name, set_func, values in self.sweep_parameters]
+        self._set_thread = None
+        self._set_exception = None
+
+        self._start_set_thread(None, points[0][2])
+        self._wait_for_set_thread()
+        try:
+            for k,(run_identifier, idxs, values) in enumerate(points):
+                if k+1 < len(points):
+                    next_values = points[k+1][2]
+                    start_next = lambda values=values, next_values=next_values: self._start_set_thread(values, next_values)
+                    self.measurement.acquisition_finished_callback = start_next if self.overlap else None
+                else:
+                    start_next = None
+                    self.measurement.acquisition_finished_callback = None
+
+                run_params = dict(zip(names, values))
+                if self.get_run_params is not None:
+                    run_params.update(self.get_run_params())
+                self.measurement.run(run_identifier=run_identifier, run_params=run_params, **run_kw)
+                self.measurement.mark_run_completed(run_identifier)
+                logging.info(f'{self.measurement.name}: finished sweep point {k+1}/{len(points)}: {run_params}')
+
+                if start_next is not None:
+                    # no-op if the measurement already started it in acquisition_finished
+                    start_next()
+                    self._wait_for_set_thread()
+        finally:
+            self.measurement.acquisition_finished_callback = None
+            if self._set_thread is not None:
+                self._set_thread.join()
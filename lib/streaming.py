@@ -0,0 +1,100 @@
+"""
+Created 2026
+
+@author: B.J.Hensen
+
+This work is licensed under the GNU Affero General Public License v3.0
+
+Copyright (c) 2026, Hensen Lab
+
+All rights reserved.
+
+This module contains BlockStreamer, which acquires data blocks and writes them
+to disk on two background threads, used by the streaming measurements.
+"""
+
+import threading
+import queue
+import logging
+
+class BlockStreamer:
+    """
+    Calls get_block repeatedly on an acquisition thread, and write_blocks with the list of
+    all blocks queued so far on a writer thread. The threads are connected by a bounded queue
+    (max_queued_blocks): if writing falls behind, acquisition blocks instead of the queue
+    growing without limit. get_block may return None if there is no new data.
+
+    On stop, the block that is being acquired is still queued, and the writer drains the queue
+    before it exits, so no acquired block is lost. The first exception raised on either thread
+    is re-raised by raise_exception.
+    """
+
+    def __init__(self, name, get_block, write_blocks, max_queued_blocks=100, timeout=0.5):
+        self.name = name
+        self.get_block = get_block
+        self.write_blocks = write_blocks
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max_queued_blocks)
+        self.exceptions = []
+        self._acquiring = threading.Event()
+        self._writing = threading.Event()
+        self._acquire_thread = threading.Thread(target=self._acquire)
+        self._write_thread = threading.Thread(target=self._write)
+
+    def start(self):
+        self._acquiring.set()
+        self._writing.set()
+        self._acquire_thread.start()
+        self._write_thread.start()
+
+    def is_alive(self):
+        return self._acquire_thread.is_alive() and self._write_thread.is_alive()
+
+    def stop(self):
+        """
+        Stops acquiring, and waits until all queued blocks are written.
+        """
+        self._acquiring.clear()
+        if self._acquire_thread.is_alive():
+            self._acquire_thread.join()
+        self._writing.clear()
+        if self._write_thread.is_alive():
+            self._write_thread.join()
+
+    def raise_exception(self):
+        if len(self.exceptions) > 0:
+            raise self.exceptions[0]
+
+    def _acquire(self):
+        try:
+            queue_full_logged = False
+            while self._acquiring.is_set():
+                block = self.get_block()
+                if block is None:
+                    continue
+                # back-pressure: wait for the writer instead of buffering without limit.
+                # The writer runs until acquisition has stopped, so the last block is also queued.
+                while len(self.exceptions) == 0:
+                    try:
+                        self.queue.put(block, timeout=self.timeout)
+                        break
+                    except queue.Full:
+                        if not queue_full_logged:
+                            logging.warning(f'{self.name}: writing to disk falls behind, polling is throttled.')
+                            queue_full_logged = True
+        except Exception as e:
+            self.exceptions.append(e)
+
+    def _write(self):
+        try:
+            while self._writing.is_set() or not(self.queue.empty()):
+                try:
+                    blocks = [self.queue.get(timeout=self.timeout)]
+                except queue.Empty:
+                    continue
+                # write everything that is queued at once, so each dataset is only resized once
+                while not(self.queue.empty()):
+                    blocks.append(self.queue.get_nowait())
+                self.write_blocks(blocks)
+        except Exception as e:
+            self.exceptions.append(e)
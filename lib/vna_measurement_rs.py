@@ -13,10 +13,12 @@ All rights reserved.
 """
 
 import time
+import logging
 import numpy as np
 import matplotlib.pyplot as plt
 
 from lib.measurement import Measurement
+from lib.streaming import BlockStreamer
 
 from analysis.data_tools import phase_unwrapped_and_offset, magnitude_dB
 
@@ -28,75 +30,191 @@ class VNAMeasurement(Measurement):
         
         self.params['do_plot'] = True
         self.params['vna_opc_update_time'] = 0.5
+        self.params.setdefault('bulk_readout', False) # sweep all channels at once and read all traces in one query per channel
         
     def run(self, setup=True, run_identifier=None , run_params={},skip_update_channels = [], stop_cont_meas=True):
-        
+        """
+        Runs with a run_identifier are marked completed in the data file once saved. Completed runs are skipped,
+        so a measurement created with resume_filepath continues where it was interrupted.
+        """
+        if run_identifier is not None and self.is_run_completed(run_identifier):
+            logging.info(f'{self.name}: skipping completed run {run_identifier}')
+            return
+
         if setup:
             self.setup()
             
-        if run_identifier is not None:
-            run_h5_group = self.h5data.create_group('{}'.format(run_identifier))
-            self.save_dict(run_params,run_h5_group.name+'/')
-        else:
-            run_h5_group = self.h5data
+        run_h5_group = self.create_run_group(run_identifier, run_params)
 
         if self.params['do_plot']:
             n_traces = len(self.vna.traces)
             figname = 'VNA Measurement' if run_identifier is None else f'VNA Measurement {run_identifier}'
             fig = plt.figure(figsize=(4*n_traces,5), num=figname)
+            self.fig = fig
             fig.clf()
             axs = fig.subplots(nrows=2,ncols = n_traces,squeeze=False, sharex=True)
 
 
+        traces_data = self.acquire_traces(skip_update_channels=skip_update_channels, stop_cont_meas=stop_cont_meas)
+
+        for i,(trace,vna_parameter,freq,data) in enumerate(traces_data):
+            g = run_h5_group.create_group(trace.name)
+            g.create_dataset('frequency', data = freq)
+            g.create_dataset(vna_parameter, data = data)
+            if self.params['do_plot']:
+                axs[0,i].set_title(vna_parameter)
+                axs[0,i].plot(freq/1e9,magnitude_dB(data), label = vna_parameter)
+                axs[1,i].plot(freq/1e9,phase_unwrapped_and_offset(data), label = vna_parameter)
+                axs[1,i].set_xlabel('Frequency (GHz)')
+        self.h5data.flush()
+        if run_identifier is not None:
+            self.mark_run_completed(run_identifier)
+
+        if self.params['do_plot']:
+            axs[0,0].set_ylabel('Power (dB)')
+            axs[1,0].set_ylabel('phase (degrees)')
+            
+            fig_title, fig_save_fp = self.get_figure_title_and_path(appendix = run_identifier)
+            fig.suptitle(fig_title)    
+            fig.tight_layout()
+            fig.savefig(fig_save_fp, bbox_inches='tight')
+            fig.canvas.draw()
+            fig.canvas.flush_events()
+            
+            
+    def get_frequencies(self, trace):
+        trace.update_lin_traces()
+        return np.array(trace.trace_mag_phase.setpoints[0][0])
+
+    def acquire_traces(self, skip_update_channels=[], stop_cont_meas=True):
+        """
+        Sweeps (except for the channels in skip_update_channels) and reads all vna traces,
+        returns a list of (trace, vna_parameter, frequencies, complex data) tuples.
+        With params['bulk_readout'], all channels are swept with a single INIT:ALL and the traces are read 
+        with one query per channel, instead of sweeping and reading trace by trace in order.
+        Calls acquisition_finished once the vna is no longer needed.
+        """
+        traces_data = []
         updated_channels = skip_update_channels.copy()
         try:
             if stop_cont_meas:
                 self.vna.cont_meas.set(False)
 
-            for i,trace in enumerate(self.vna.traces):
+            bulk_readout = self.params['bulk_readout'] and len(skip_update_channels) == 0
+            if bulk_readout:
+                self.vna.sweep_all_channels(blocking=False).wait(callback=self.wait_for_vna)
+                bulk_data = self.vna.get_all_sweep_data(update=False)
+
+            for trace in self.vna.traces:
                 do_update = trace._ch not in updated_channels
                 
-                trace.update_lin_traces()
-                freq = np.array(trace.trace_mag_phase.setpoints[0][0])
+                freq = self.get_frequencies(trace)
                 
-                ###new does not work quite well
-                # if do_update:
-                #     trace.start_sweep()
-                #     print(f'taking {trace.avg():d} averages')
-                #     for j in range(trace.avg()):
-                #         if j>0: print(i, end=' ')
-                #         trace.init_single()
-                #         while not self.vna.operation_complete():
-                #             if self.params['do_plot']:
-                #                 t0 = time.time()
-                #                 while time.time()-t0 < self.params['vna_opc_update_time']:
-                #                     fig.canvas.flush_events()
-                #                     time.sleep(0.001)
-                #             else:
-                #                 time.sleep(self.params['vna_opc_update_time'])
-                # data = trace._get_sweep_data(force_polar=True, update=False)   
-                ###
-                
-                ###old
-                data = trace._get_sweep_data(force_polar=True, update=do_update)
-                ###
+                if bulk_readout:
+                    data = bulk_data[trace.short_name]
+                else:
+                    if do_update:
+                        trace.start_sweep()
+                        logging.debug(f'{self.name}: taking {trace.avg():d} averages')
+                        trace.sweep_async().wait(callback=self.wait_for_vna)
+                    data = trace._get_sweep_data(force_polar=True, update=False)
                 
                 updated_channels.append(trace._ch)
-                
-                g = run_h5_group.create_group(trace.name)
-                g.create_dataset('frequency', data = freq)
-                vna_parameter = trace.vna_parameter.get()
-                g.create_dataset(vna_parameter, data = data)
-                if self.params['do_plot']:
-                    axs[0,i].set_title(vna_parameter)
-                    axs[0,i].plot(freq/1e9,magnitude_dB(data), label = vna_parameter)
-                    axs[1,i].plot(freq/1e9,phase_unwrapped_and_offset(data), label = vna_parameter)
-                    axs[1,i].set_xlabel('Frequency (GHz)')
-                self.h5data.flush()
+                traces_data.append((trace, trace.vna_parameter.get(), freq, data))
         finally:
             if stop_cont_meas:
                 self.vna.cont_meas.set(True)
         
+        self.acquisition_finished()
+        return traces_data
+
+    def wait_for_vna(self):
+        """
+        Called between polls of the VNA sweep status, keeps the figures responsive.
+        """
+        if self.params['do_plot'] and hasattr(self,'fig'):
+            t0 = time.time()
+            while time.time()-t0 < self.params['vna_opc_update_time']:
+                self.fig.canvas.flush_events()
+                time.sleep(0.001)
+        else:
+            time.sleep(self.params['vna_opc_update_time'])
+            
+    def finish(self,save_vna_snapshot=True,update_vna_snapshot=True,**kwargs):
+        if save_vna_snapshot and self.h5data:
+            try:
+                self.save_dict(self.vna.snapshot(update=update_vna_snapshot),'vna_snapshot/')
+            except Exception:
+                # e.g. after a VISA timeout, still close the file so the measurement can be resumed
+                logging.exception(f'{self.name}: could not save the vna snapshot')
+        super().finish(**kwargs)
+        
+
+class VNASegmentedMeasurement(VNAMeasurement):
+    """
+    Takes a multi-segment scan in a single segmented sweep, instead of stepping e.g. the center frequency
+    and sweeping for each step. Set up the segment table first with trace.setup_segmented_sweep(segments).
+    On readout the data is split into the segments, and each segment is saved as its own run group
+    f'{run_identifier}_{k}' (or f'{k}' without run_identifier), with the segment settings as run_params, 
+    the same layout as a stepped scan.
+    """
+
+    def get_frequencies(self, trace):
+        return np.concatenate(trace.segment_frequencies())
+
+    def run(self, setup=True, run_identifier=None , run_params={},skip_update_channels = [], stop_cont_meas=True):
+        
+        n_segments = max([len(trace._segments) for trace in self.vna.traces])
+        segment_identifiers = [f'{k}' if run_identifier is None else f'{run_identifier}_{k}' for k in range(n_segments)]
+        if all([self.is_run_completed(segment_identifier) for segment_identifier in segment_identifiers]):
+            logging.info(f'{self.name}: skipping completed run {run_identifier}')
+            return
+
+        if setup:
+            self.setup()
+
+        # remove segment groups left by an interrupted run
+        for segment_identifier in segment_identifiers:
+            if segment_identifier in self.h5data:
+                logging.warning(f'{self.name}: removing data of uncompleted run {segment_identifier}')
+                del self.h5data[segment_identifier]
+
+        if self.params['do_plot']:
+            n_traces = len(self.vna.traces)
+            figname = 'VNA Measurement' if run_identifier is None else f'VNA Measurement {run_identifier}'
+            fig = plt.figure(figsize=(4*n_traces,5), num=figname)
+            self.fig = fig
+            fig.clf()
+            axs = fig.subplots(nrows=2,ncols = n_traces,squeeze=False, sharex=True)
+
+        traces_data = self.acquire_traces(skip_update_channels=skip_update_channels, stop_cont_meas=stop_cont_meas)
+
+        for i,(trace,vna_parameter,freq,data) in enumerate(traces_data):
+            segments_freq = np.split(freq, np.cumsum([len(f) for f in trace.segment_frequencies()])[:-1])
+            for k,(segment,seg_freq,seg_data) in enumerate(zip(trace._segments, segments_freq, trace.split_segments(data))):
+                segment_identifier = f'{k}' if run_identifier is None else f'{run_identifier}_{k}'
+                if segment_identifier in self.h5data:
+                    seg_h5_group = self.h5data[segment_identifier]
+                else:
+                    segment_params = dict(run_params)
+                    segment_params.update(segment)
+                    segment_params['center_frequency'] = (segment['start']+segment['stop'])/2
+                    seg_h5_group = self.create_run_group(segment_identifier, segment_params)
+                g = seg_h5_group.create_group(trace.name)
+                g.create_dataset('frequency', data = seg_freq)
+                g.create_dataset(vna_parameter, data = seg_data)
+                if self.params['do_plot']:
+                    axs[0,i].plot(seg_freq/1e9,magnitude_dB(seg_data))
+                    axs[1,i].plot(seg_freq/1e9,phase_unwrapped_and_offset(seg_data))
+            if self.params['do_plot']:
+                axs[0,i].set_title(vna_parameter)
+                axs[1,i].set_xlabel('Frequency (GHz)')
+        self.h5data.flush()
+        for segment_identifier in segment_identifiers:
+            self.mark_run_completed(segment_identifier)
+        if run_identifier is not None:
+            self.mark_run_completed(run_identifier)
+
         if self.params['do_plot']:
             axs[0,0].set_ylabel('Power (dB)')
             axs[1,0].set_ylabel('phase (degrees)')
@@ -107,13 +225,121 @@ class VNAMeasurement(Measurement):
             fig.savefig(fig_save_fp, bbox_inches='tight')
             fig.canvas.draw()
             fig.canvas.flush_events()
-            
-            
-    def finish(self,save_vna_snapshot=True,update_vna_snapshot=True,**kwargs):
-        if save_vna_snapshot:
-             self.save_dict(self.vna.snapshot(update=update_vna_snapshot),'vna_snapshot/')
-        super().finish(**kwargs)
-        
+
+
+class VNACWStreamMeasurement(VNAMeasurement):
+    """
+    Streams CW time traces of the VNA to growable HDF5 datasets, see ZNBCWStream. Set up one trace, 
+    or two traces on different channels for double buffering, with trace.setup_cw_sweep() 
+    and identical cw_frequency, npts and bandwidth. 
+    Blocks are acquired on a background thread and written on another, connected by a bounded queue, 
+    see lib.streaming.BlockStreamer.
+    Each block is a row of the I and Q datasets, with its trigger time in block_timestamp and 
+    the channel that took it in block_channel.
+    """
+
+    def __init__(self, name, vna, **kwargs):
+        super().__init__(name, vna, **kwargs)
+        self.params.setdefault('duration', 10) #s
+        self.params.setdefault('update_time', 1) #s
+        self.params.setdefault('max_queued_blocks', 100)
+        self.params.setdefault('stream_poll_interval', 0.001) #s
+        self.params.setdefault('plot_blocks', 10)
+
+    def run(self, setup=True, run_identifier=None, run_params={}, traces=None):
+        """
+        Stream until params['duration'] (s) has passed, or the plot window is closed.
+        traces: the traces to stream, defaults to all vna traces.
+        """
+        if setup:
+            self.setup()
+
+        run_h5_group = self.create_run_group(run_identifier, run_params)
+
+        traces = self.vna.traces if traces is None else traces
+        stream = traces[0].cw_stream(*traces[1:], poll_interval=self.params['stream_poll_interval'])
+        stream.start()
+        npts = stream.npts
+        self._block_time = np.linspace(0, stream.block_duration, npts, endpoint=False)
+
+        dsets = {}
+        for k in ['I', 'Q']:
+            dsets[k] = run_h5_group.create_dataset(k, (0,npts), maxshape=(None,npts), dtype=np.float64, chunks=(1,npts))
+        dsets['block_timestamp'] = run_h5_group.create_dataset('block_timestamp', (0,), maxshape=(None,), dtype=np.float64, chunks=True)
+        dsets['block_channel'] = run_h5_group.create_dataset('block_channel', (0,), maxshape=(None,), dtype=np.int64, chunks=True)
+        run_h5_group.attrs['cw_frequency'] = traces[0].cw_frequency()
+        run_h5_group.attrs['bandwidth'] = traces[0].bandwidth()
+        run_h5_group.attrs['block_duration'] = stream.block_duration
+        run_h5_group.attrs['vna_parameter'] = traces[0].vna_parameter()
+
+        if self.params['do_plot']:
+            self.fig = plt.figure(figsize=(8,5), num='VNA CW Stream')
+            self.fig.clf()
+            self.axs = self.fig.subplots(nrows=2, sharex=True)
+            self.plot_lines = [ax.plot([0,1],[0,1],'-')[0] for ax in self.axs]
+            self.axs[0].set_ylabel('Power (dB)')
+            self.axs[1].set_ylabel('phase (degrees)')
+            self.axs[1].set_xlabel('Time (s)')
+            fig_title, fig_save_fp = self.get_figure_title_and_path(appendix = run_identifier)
+            self.fig.suptitle(fig_title)
+            self.fig.tight_layout()
+
+        self.blocks_written = 0
+        self.latest_blocks = []
+        self._streamer = BlockStreamer(self.name, stream.get_block, lambda blocks: self._write_blocks(dsets, blocks),
+                                       max_queued_blocks=self.params['max_queued_blocks'], timeout=self.params['update_time'])
+
+        self._streamer.start()
+        t0 = time.time()
+        try:
+            while time.time()-t0 < self.params['duration'] and self._streamer.is_alive():
+                logging.info(f'{self.name}: blocks written: {self.blocks_written}, queued blocks: {self._streamer.queue.qsize()}')
+                if self.params['do_plot']:
+                    if not(plt.fignum_exists(self.fig.number)):
+                        break
+                    self.update_plot()
+                    plt.pause(self.params['update_time'])
+                else:
+                    time.sleep(self.params['update_time'])
+        finally:
+            self._streamer.stop()
+            stream.stop()
+            self.h5data.flush()
+
+        self._streamer.raise_exception()
+
+        self.acquisition_finished()
+
+        if self.params['do_plot'] and plt.fignum_exists(self.fig.number):
+            self.update_plot()
+            self.fig.savefig(fig_save_fp, bbox_inches='tight')
+
+    def _write_blocks(self, dsets, blocks):
+        t_start, channel, i, q = zip(*blocks)
+        new_data = {'block_timestamp': np.array(t_start), 'block_channel': np.array(channel), 
+                    'I': np.stack(i), 'Q': np.stack(q)}
+        n = len(blocks)
+        for k, dset in dsets.items():
+            dset.resize(self.blocks_written+n, axis=0)
+            dset[self.blocks_written:] = new_data[k]
+        self.blocks_written += n
+        self.h5data.flush()
+        self.latest_blocks = (self.latest_blocks + blocks)[-self.params['plot_blocks']:]
+
+    def update_plot(self):
+        blocks = self.latest_blocks
+        if len(blocks) == 0:
+            return
+        t = np.concatenate([t_start + self._block_time for t_start,_,_,_ in blocks]) - blocks[0][0]
+        data = np.concatenate([i + 1j*q for _,_,i,q in blocks])
+        self.plot_lines[0].set_data(t, magnitude_dB(data))
+        self.plot_lines[1].set_data(t, np.angle(data, deg=True))
+        for ax in self.axs:
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
 
 class VNACurrentMeasurement(VNAMeasurement):
     def __init__(self, name, vna, current_source, **kwargs):
@@ -19,6 +19,7 @@ import matplotlib.pyplot as plt
 import logging
 
 from lib.measurement import Measurement
+from lib.streaming import BlockStreamer
 from analysis.data_tools import phase_unwrapped_and_offset, magnitude_dB
 
 class ZIMeasurement(Measurement):
@@ -86,13 +87,8 @@ class ZISweeperMeasurement(ZIMeasurement):
         if setup:
             self.setup()
         
-        if run_identifier is not None:
-            run_h5_group = self.h5data.create_group('{}'.format(run_identifier))
-            self.save_dict(run_params,run_h5_group.name+'/')
-            plot_label  = run_identifier
-        else:
-            run_h5_group = self.h5data
-            plot_label = ''
+        run_h5_group = self.create_run_group(run_identifier, run_params)
+        plot_label = run_identifier if run_identifier is not None else ''
 
         if self.params['do_plot']:
             
@@ -112,11 +108,9 @@ class ZISweeperMeasurement(ZIMeasurement):
             self.fig.canvas.flush_events()
 
 
-        for i,sample_node in enumerate(self.params['sample_nodes']): 
-            for save_key in self.params['save_data_keys']:
-                y_data = run_h5_group.create_dataset(f'data_node-{i:d}-{save_key}',(self.sweeper.samplecount(),self.sweeper.loopcount()),dtype=np.float64)
-                y_data.attrs['sample_node'] = sample_node
-                y_data.attrs['grid_node'] = self.params['gridnode']
+        dsets = self.create_datasets(run_h5_group)
+        # per sample node and loop, the grid points that are already stored
+        stored = [{} for sample_node in self.params['sample_nodes']]
 
         self.sweeper.execute()
         time.sleep(self.params['update_time'])
@@ -129,21 +123,27 @@ class ZISweeperMeasurement(ZIMeasurement):
             data = self.sweeper.read()
             #print(data.keys())
             logging.info(f'{self.name}: loop: {cur_loop+1}/{self.sweeper.loopcount()}, sweep progress: {self.sweeper.progress()}')#, remaining time: {self.sweeper.remaining()}')
+            new_plot_data = False
             for i,sample_node in enumerate(self.params['sample_nodes']):
                 if sample_node in data:
                     s_data = data[sample_node]
+                    # read returns the cumulative sweep data, one entry per loop
                     for loop_idx, loop_data in enumerate(s_data):
-                        if loop_idx > 0:
-                            cur_loop+=1
-                            self.plot_lines[i] = [self.axs[0,i].plot([0,1],[1,2],'.-', label=f'run-{plot_label}-loop-{cur_loop}')[0],self.axs[1,i].plot([0,1],[1,2],'.-',label=f'loop-{cur_loop}')[0]]
-                            self.axs[0,i].legend()
-                        if len(loop_data)>0:
-                            for save_key in self.params['save_data_keys']:
-                                run_h5_group[f'data_node-{i:d}-{save_key}'][:,cur_loop] = loop_data[0][save_key]
-                            if self.params['do_plot']:
-                                self.update_plot_line(i,loop_data[0]['grid'],loop_data[0]['r'],loop_data[0]['phase'],cur_loop)
-                                self.fig.canvas.draw()
-                                self.fig.canvas.flush_events()
+                        if len(loop_data) == 0:
+                            continue
+                        if loop_idx not in stored[i]:
+                            stored[i][loop_idx] = np.zeros(self.sweeper.samplecount(), dtype=bool)
+                            if loop_idx > 0 and self.params['do_plot']:
+                                self.plot_lines[i] = [self.axs[0,i].plot([0,1],[1,2],'.-', label=f'run-{plot_label}-loop-{loop_idx}')[0],self.axs[1,i].plot([0,1],[1,2],'.-',label=f'loop-{loop_idx}')[0]]
+                                self.axs[0,i].legend()
+                        cur_loop = max(cur_loop, loop_idx)
+                        if self.save_new_points(dsets[i], loop_data[0], stored[i][loop_idx], loop_idx) and self.params['do_plot']:
+                            self.update_plot_line(i,loop_data[0]['grid'],loop_data[0]['r'],loop_data[0]['phase'],loop_idx)
+                            new_plot_data = True
+            
+            if new_plot_data:
+                self.fig.canvas.draw()
+                self.fig.canvas.flush_events()
                         
             self.h5data.flush()
             if finished:
@@ -154,10 +154,52 @@ class ZISweeperMeasurement(ZIMeasurement):
             else:
                 time.sleep(self.params['update_time'])
 
+        self.sweeper.finish()
+        self.acquisition_finished()
+
         if self.params['do_plot']:
             self.fig.savefig(fig_save_fp, bbox_inches='tight')
-   
-        self.sweeper.finish()
+
+    def create_datasets(self, run_h5_group):
+        """
+        Creates the data_node-{i}-{save_key} datasets for all sample nodes and save keys at once, 
+        returns a list (per sample node) of dicts {save_key: dataset}.
+        """
+        shape = (self.sweeper.samplecount(),self.sweeper.loopcount())
+        dsets = []
+        for i,sample_node in enumerate(self.params['sample_nodes']): 
+            node_dsets = {}
+            for save_key in self.params['save_data_keys']:
+                y_data = run_h5_group.create_dataset(f'data_node-{i:d}-{save_key}',shape,dtype=np.float64, fillvalue=np.nan)
+                y_data.attrs['sample_node'] = sample_node
+                y_data.attrs['grid_node'] = self.params['gridnode']
+                node_dsets[save_key] = y_data
+            dsets.append(node_dsets)
+        return dsets
+
+    def save_new_points(self, node_dsets, sweep_data, stored, loop_idx):
+        """
+        Writes only the grid points of sweep_data that were measured since the previous call, 
+        stored is a boolean array of the already stored points, which is updated in place.
+        A point counts as measured once the values of all save keys are finite, not just its grid setpoint, 
+        since stored points are not written again.
+        Returns True if any new points were written.
+        """
+        values = {save_key: np.asarray(sweep_data[save_key]) for save_key in node_dsets}
+        n = min(len(v) for v in values.values())
+        measured = np.all([np.isfinite(v[:n]) for v in values.values()], axis=0)
+        new_idxs = np.flatnonzero(measured & ~stored[:n])
+        if len(new_idxs) == 0:
+            return False
+        if new_idxs[-1] - new_idxs[0] + 1 == len(new_idxs):
+            # contiguous block, e.g. sequential scan mode
+            sel = slice(new_idxs[0], new_idxs[-1]+1)
+        else:
+            sel = new_idxs
+        for save_key, dset in node_dsets.items():
+            dset[sel,loop_idx] = values[save_key][sel]
+        stored[new_idxs] = True
+        return True
 
     def update_plot_line(self,i,x,r,phase, cur_loop):
         self.plot_lines[i][0].set_data(x,r)
@@ -171,7 +213,13 @@ class ZIScopeMeasurement(ZIMeasurement):
 
     """
 
-        Take 1 or more records from the scope, does not support segmented data taking yet.
+        Take 1 or more records from the scope, optionally in segmented mode (params['scope_segments'] > 1, 
+        requires the DIG option). Records are appended to a single stacked 'traces' dataset of shape 
+        (records*segments, channels, samples) as they arrive, so the number of records (params['scope_records'], 
+        defaults to params['scope_history_length']) is not limited by memory. The average over all records 
+        (of the magnitude in fft mode) is computed incrementally and saved as 'average_trace'.
+        The module history (params['scope_history_length']) must hold all records that arrive between two reads 
+        (params['scope_read_interval']), records that are dropped are logged and counted in the 'records_dropped' attribute.
         You can call the run function multiple times.
 
         See https://docs.zhinst.com/labone_api_user_manual/modules/scope/index.html
@@ -197,10 +245,16 @@ class ZIScopeMeasurement(ZIMeasurement):
 
 
         self.scope.enable(0) #stop running the scope
-        if self.params['scope_history_length'] ==1:
+        self.scope_records = self.params.get('scope_records', self.params['scope_history_length'])
+        if self.scope_records ==1:
             self.scope.single(1)
         else:
             self.scope.single(0)
+        
+        self.scope_segments = self.params.get('scope_segments', 1)
+        # always set, so a previous segmented run on the same instrument does not carry over
+        self.scope.segments.enable(int(self.scope_segments > 1))
+        self.scope.segments.count(self.scope_segments)
 
         self.sampling_rate = self.device.clockbase()/2**self.scope.time()
         
@@ -221,11 +275,7 @@ class ZIScopeMeasurement(ZIMeasurement):
         if setup:
             self.setup()
             
-        if run_identifier is not None:
-            run_h5_group = self.h5data.create_group('{}'.format(run_identifier))
-            self.save_dict(run_params,run_h5_group.name+'/')
-        else:
-            run_h5_group = self.h5data
+        run_h5_group = self.create_run_group(run_identifier, run_params)
 
         if self.params['do_plot']:
             nrows = 1#2 if self.params['scope_fft_mode'] else 1
@@ -240,41 +290,73 @@ class ZIScopeMeasurement(ZIMeasurement):
         self.scope.enable(1)
         self.device.session.sync()
 
-        while 1:
-            progress= self.scope_module.progress()
-            records = self.scope_module.records()
-            if progress < 1. or  records < self.params['scope_history_length']:
-                logging.info(f'{self.name}: scope progress: {progress}, scope records: {records}/{self.params["scope_history_length"]}')
-                time.sleep(0.3)
-            else:
-                break
+        traces = None
+        read_timestamps = set()
+        records_read = 0
+        records_seen = 0
+        records_dropped = 0
+        while records_read < self.scope_records:
+            time.sleep(self.params.get('scope_read_interval', 0.3))
+            data = self.scope_module.read()
+            if self.scope.wave not in data:
+                continue
+            # the module returns all records in its history, only keep the ones not read before
+            new_records = [record for record in data[self.scope.wave] if record[0]['timestamp'] not in read_timestamps]
+            # records acquired by the module that left its history before they were read are lost
+            records_seen += len(new_records)
+            dropped = int(self.scope_module.records()) - records_seen
+            if dropped > records_dropped:
+                logging.warning(f'{self.name}: {dropped-records_dropped} scope records were dropped, ' \
+                                'increase scope_history_length or decrease scope_read_interval.')
+                records_dropped = dropped
+            new_records = new_records[:self.scope_records - records_read]
+            logging.info(f'{self.name}: scope progress: {self.scope_module.progress()}, scope records: {records_read+len(new_records)}/{self.scope_records}')
+            if len(new_records) == 0:
+                continue
+
+            if self.params['check_scope_record_flags']:
+                self.check_scope_record_flags(new_records)
+
+            waves = self.get_record_waves(new_records)
+            if traces is None:
+                n_samples = waves.shape[-1]
+                if self.params['scope_fft_mode']:
+                    x_axis = np.linspace(0, self.sampling_rate / 2, n_samples)
+                else:
+                    x_axis = 1/self.sampling_rate*np.arange(n_samples)
+                run_h5_group.create_dataset('x_axis', data = x_axis)
+                traces = run_h5_group.create_dataset('traces', (0,)+waves.shape[1:], maxshape=(None,)+waves.shape[1:], 
+                                                     dtype=waves.dtype, chunks=(1,)+waves.shape[1:])
+                record_timestamps = run_h5_group.create_dataset('record_timestamp', (0,), maxshape=(None,), dtype=np.uint64)
+                trace_sum = np.zeros(waves.shape[1:])
+            
+            n_traces = traces.shape[0]
+            traces.resize(n_traces+len(waves), axis=0)
+            traces[n_traces:] = waves
+            record_timestamps.resize(n_traces+len(waves), axis=0)
+            record_timestamps[n_traces:] = np.repeat([record[0]['timestamp'] for record in new_records], self.scope_segments)
+            trace_sum += np.sum(np.abs(waves) if self.params['scope_fft_mode'] else waves, axis=0)
+            self.h5data.flush()
 
-        data = self.scope_module.read()[self.scope.wave]
-        self.data_tmp=data
+            read_timestamps.update(record[0]['timestamp'] for record in data[self.scope.wave])
+            records_read += len(new_records)
 
         self.scope.enable(0)
+        self.acquisition_finished()
 
-        if self.params['check_scope_record_flags']:
-            self.check_scope_record_flags(data)
+        average_trace = trace_sum/traces.shape[0]
+        run_h5_group.create_dataset('average_trace', data = average_trace)
+        traces.attrs['segments'] = self.scope_segments
+        traces.attrs['records_dropped'] = records_dropped
 
-        totalsamples = data[0][0]['totalsamples']
-        if self.params['scope_fft_mode']:
-            x_axis = np.linspace(0, self.sampling_rate / 2, totalsamples)
-        else:
-            x_axis = 1/self.sampling_rate*np.arange(totalsamples)
-
-        run_h5_group.create_dataset('x_axis', data = x_axis)
-
-        for i, record in enumerate(data):
-            run_h5_group.create_dataset(f'trace_{i:d}', data = record[0]['wave'])
-            if self.params['do_plot']:
-                for j,ch in enumerate(self.scope_channels):
-                    y = record[0]['wave'][j,:]
+        if self.params['do_plot']:
+            for j,ch in enumerate(self.scope_channels):
+                for y,label in [(traces[-1,j,:], f'trace {traces.shape[0]-1:d}'),(average_trace[j,:],'average')]:
                     if self.params['scope_fft_mode']:  
-                            axs[0,j].plot(x_axis,magnitude_dB(np.abs(y)), label = f'trace {i:d}')
-                            #axs[1,j].plot(x_axis,phase_unwrapped_and_offset(np.angle(y)), label = f'trace {i:d}')
+                            axs[0,j].plot(x_axis,magnitude_dB(np.abs(y)), label = label)
                     else:
-                            axs[0,j].plot(x_axis,y, label = f'trace {i:d}')                    
+                            axs[0,j].plot(x_axis,y, label = label)                    
+                axs[0,j].legend()
           
         self.h5data.flush()
         
@@ -301,6 +383,17 @@ class ZIScopeMeasurement(ZIMeasurement):
         self.scope_module.close()
 
 
+    def get_record_waves(self, scope_records):
+        """
+        Returns the waves of the scope records stacked as (records*segments, channels, samples), 
+        in segmented mode each record is split into its segments.
+        """
+        waves = np.stack([np.reshape(record[0]['wave'],(len(self.scope_channels),-1)) for record in scope_records])
+        if self.scope_segments > 1:
+            waves = np.reshape(waves, (len(scope_records), len(self.scope_channels), self.scope_segments, -1))
+            waves = np.reshape(np.swapaxes(waves, 1, 2), (-1, len(self.scope_channels), waves.shape[-1]))
+        return waves
+
     def check_scope_record_flags(self,scope_records):
         """
         From https://docs.zhinst.com/zhinst-qcodes/en/latest/examples/scope_module.html
@@ -328,6 +421,163 @@ class ZIScopeMeasurement(ZIMeasurement):
           
         
         
+class ZIDAQMeasurement(ZIMeasurement):
+
+    """
+    Continuously stream demodulator samples to growable HDF5 datasets, by subscribing to the 
+    sample nodes and polling the data server. Polling and writing each run on a background thread,
+    connected by a bounded queue: if writing falls behind, polling blocks and the data server 
+    buffers the samples, instead of the queue growing without limit.
+    x, y and timestamp are taken from the demodulator samples, r and phase are computed from x and y.
+
+    See https://docs.zhinst.com/labone_api_user_manual/data_acquisition/subscribe_poll.html
+    """
+
+    def __init__(self, name, device, **kwargs):
+        super().__init__(name, device, **kwargs)
+        self.params.setdefault('do_plot', True)
+        self.params.setdefault('duration', 10) #s
+        self.params.setdefault('update_time', 1) #s
+        self.params.setdefault('poll_time', 0.1) #s, recording time per poll
+        self.params.setdefault('poll_timeout', 0.5) #s
+        self.params.setdefault('max_queued_polls', 100)
+        self.params.setdefault('save_data_keys', ['timestamp', 'x', 'y', 'r', 'phase'])
+        self.params.setdefault('plot_samples', 10000)
+
+    def setup(self):
+        super().setup()
+        self.daq = self.device.session.daq_server
+        self.params['sample_nodes'] = [s.lower() for s in self.params['sample_nodes']]
+
+        if self.params['do_plot']:
+            matplotlib.use('Qt5Agg')
+            plt.close('all')
+            ncols=len(self.params['sample_nodes'])
+            self.fig = plt.figure(figsize=(4*ncols,6), num='ZI DAQ Measurement')
+            self.fig.clf()
+            self.axs = self.fig.subplots(nrows=2,ncols=ncols,squeeze=False, sharex=True)
+
+    def create_datasets(self, run_h5_group):
+        dsets = []
+        for i,sample_node in enumerate(self.params['sample_nodes']):
+            node_dsets = {}
+            for save_key in self.params['save_data_keys']:
+                dtype = np.uint64 if save_key == 'timestamp' else np.float64
+                dset = run_h5_group.create_dataset(f'data_node-{i:d}-{save_key}', (0,), maxshape=(None,), dtype=dtype, chunks=True)
+                dset.attrs['sample_node'] = sample_node
+                node_dsets[save_key] = dset
+            dsets.append(node_dsets)
+        return dsets
+
+    def run(self, setup=True, run_identifier=None, run_params={}):
+        """
+        Stream data until params['duration'] (s) has passed, or the plot window is closed.
+        """
+
+        if setup:
+            self.setup()
+
+        run_h5_group = self.create_run_group(run_identifier, run_params)
+
+        dsets = self.create_datasets(run_h5_group)
+        run_h5_group.attrs['clockbase'] = self.device.clockbase()
+
+        if self.params['do_plot']:
+            self.plot_lines = []
+            for i,sample_node in enumerate(self.params['sample_nodes']):
+                self.plot_lines.append([self.axs[0,i].plot([0,1],[1,2],'-')[0],self.axs[1,i].plot([0,1],[1,2],'-')[0]])
+                self.axs[0,i].set_title(sample_node)
+                self.axs[1,i].set_xlabel('Samples')
+            self.axs[0,0].set_ylabel('Amplitude (V)')
+            self.axs[1,0].set_ylabel('Phase (rad)')
+            fig_title, fig_save_fp = self.get_figure_title_and_path(appendix = run_identifier)
+            self.fig.suptitle(fig_title)
+            self.fig.tight_layout()
+
+        self.samples_written = np.zeros(len(self.params['sample_nodes']), dtype=np.int64)
+        self.latest_samples = [{'r': np.zeros(0), 'phase': np.zeros(0)} for sample_node in self.params['sample_nodes']]
+        self._streamer = BlockStreamer(self.name, self._poll_samples, lambda blocks: self._write_samples(dsets, blocks), 
+                                       max_queued_blocks=self.params['max_queued_polls'], timeout=self.params['poll_timeout'])
+
+        for sample_node in self.params['sample_nodes']:
+            self.daq.subscribe(sample_node)
+        self.daq.sync()
+
+        self._streamer.start()
+        t0 = time.time()
+        try:
+            while time.time()-t0 < self.params['duration'] and self._streamer.is_alive():
+                logging.info(f'{self.name}: samples written: {self.samples_written}, queued polls: {self._streamer.queue.qsize()}')
+                if self.params['do_plot']:
+                    if not(plt.fignum_exists(self.fig.number)):
+                        break
+                    self.update_plot()
+                    plt.pause(self.params['update_time'])
+                else:
+                    time.sleep(self.params['update_time'])
+        finally:
+            self._streamer.stop()
+            for sample_node in self.params['sample_nodes']:
+                self.daq.unsubscribe(sample_node)
+            self.h5data.flush()
+
+        self._streamer.raise_exception()
+
+        self.acquisition_finished()
+
+        if self.params['do_plot'] and plt.fignum_exists(self.fig.number):
+            self.update_plot()
+            self.fig.savefig(fig_save_fp, bbox_inches='tight')
+
+    def _poll_samples(self):
+        data = self.daq.poll(self.params['poll_time'], int(self.params['poll_timeout']*1e3), 0, True)
+        block = {}
+        for i,sample_node in enumerate(self.params['sample_nodes']):
+            if sample_node in data and len(data[sample_node]['timestamp']) > 0:
+                block[i] = data[sample_node]
+        return block if len(block) > 0 else None
+
+    def _write_samples(self, dsets, blocks):
+        for i,node_dsets in enumerate(dsets):
+            node_blocks = [block[i] for block in blocks if i in block]
+            if len(node_blocks) == 0:
+                continue
+            new_data = self.get_sample_data(node_blocks, self.params['save_data_keys'])
+            cur_len = self.samples_written[i]
+            n = len(new_data['timestamp'])
+            for save_key, dset in node_dsets.items():
+                dset.resize((cur_len+n,))
+                dset[cur_len:] = new_data[save_key]
+            self.samples_written[i] = cur_len+n
+            for k in self.latest_samples[i]:
+                self.latest_samples[i][k] = np.concatenate((self.latest_samples[i][k],new_data[k]))[-self.params['plot_samples']:]
+        self.h5data.flush()
+
+    @staticmethod
+    def get_sample_data(node_blocks, save_data_keys):
+        """
+        Concatenates the polled demodulator samples of one node, and computes r and phase from x and y.
+        """
+        new_data = {}
+        for k in set(save_data_keys).union(['timestamp', 'x', 'y']).difference(['r', 'phase']):
+            new_data[k] = np.concatenate([np.asarray(b[k]) for b in node_blocks])
+        new_data['r'] = np.hypot(new_data['x'], new_data['y'])
+        new_data['phase'] = np.arctan2(new_data['y'], new_data['x'])
+        return new_data
+
+    def update_plot(self):
+        for i,samples in enumerate(self.latest_samples):
+            if len(samples['r']) < 2:
+                continue
+            x = np.arange(len(samples['r']))
+            self.plot_lines[i][0].set_data(x,samples['r'])
+            self.plot_lines[i][1].set_data(x,samples['phase'])
+            self.axs[0,i].set(xlim=(0,len(x)),ylim=(np.nanmin(samples['r']),np.nanmax(samples['r'])))
+            self.axs[1,i].set(ylim=(-np.pi,np.pi))
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+
 if __name__=='__main__':
     
     logging.getLogger().setLevel(logging.INFO)
@@ -0,0 +1,124 @@
+"""
+Tests of the model registry of analysis.fitting, and of fitting.fit_many with a model that takes 
+a variable number of parameters.
+"""
+
+import numpy as np
+import pytest
+
+from analysis import fitting
+
+
+def make_n_lorentz_rows(n_rows, n_peaks, rng):
+    x = np.linspace(0, 10, 400)
+    P = []
+    for i in range(n_rows):
+        a = rng.uniform(0.5, 1.5, n_peaks)
+        x0 = np.linspace(2, 8, n_peaks) + rng.uniform(-0.3, 0.3, n_peaks)
+        w = rng.uniform(0.2, 0.4, n_peaks)
+        P.append(list(a) + list(x0) + list(w) + [1., 0.02])
+    P = np.array(P)
+    Y = np.array([fitting.n_lorentz_function_linoff(x, *p) for p in P]) + rng.normal(size=(n_rows, len(x)))*0.01
+    return x, Y, P
+
+
+# parameters at which the registered jacobians are checked
+JACOBIAN_PARAMS = {
+    fitting.gauss_function: [1.3, 4.8, 0.7, 0.2],
+    fitting.lorentz_function: [1.3, 4.8, 0.7, 0.2],
+    fitting.lorentz_function_linoff: [1.3, 4.8, 0.7, 0.2, 0.05],
+    fitting.double_lorentz_function_linoff: [1.3, -0.6, 3.1, 6.2, 0.7, 0.4, 0.2, 0.05],
+    fitting.triple_lorentz_function_linoff: [1.3, -0.6, 0.9, 2.1, 4.9, 7.3, 0.7, 0.4, 1.1, 0.2, 0.05],
+    fitting.n_lorentz_function_linoff: [1.3, -0.6, 0.9, 0.5, 2.1, 4.9, 7.3, 8.8, 0.7, 0.4, 1.1, 0.3, 0.2, 0.05],
+    fitting.exp_function: [1.3, 2.4, 0.2],
+    fitting.linear_function: [1.3, 0.2],
+    fitting.sin_function: [1.3, 2.4, 0.3, 0.2],
+    fitting.decaying_sin_function: [1.3, 2.4, 0.3, 0.2, 3.5],
+    fitting.sin_sq_function: [1.3, 0.8, 0.3, 0.2],
+}
+
+
+@pytest.mark.parametrize('function', [f for f,model in fitting.MODELS.items() if model.jacobian is not None],
+                         ids=lambda f: f.__name__)
+def test_jacobian_finite_differences(function):
+    x = np.linspace(0, 10, 201)
+    p = np.array(JACOBIAN_PARAMS[function])
+    J = fitting.get_model(function).jacobian(x, *p)
+    h = 1e-6
+    J_fd = np.stack([(function(x, *(p + h*e)) - function(x, *(p - h*e)))/(2*h) for e in np.eye(len(p))], axis=-1)
+    assert J.shape == (len(x), len(p))
+    np.testing.assert_allclose(J, J_fd, rtol=1e-5, atol=1e-6)
+
+def test_fit_default_without_jacobian(monkeypatch):
+    x = np.linspace(0, 10, 101)
+    y = fitting.linear_function(x, 1.3, 0.2)
+    jacs = []
+    def curve_fit(f, x, y, p0=None, **kwargs):
+        jacs.append(kwargs.get('jac'))
+        return np.array(p0), np.eye(len(p0))
+    monkeypatch.setattr(fitting, 'curve_fit', curve_fit)
+    fitting.fit(x, y, fitting.linear_function)
+    fitting.fit(x, y, fitting.linear_function, use_jacobian=True)
+    assert jacs == [None, fitting.linear_jacobian]
+
+
+@pytest.mark.parametrize('processes, chunk_size', [(1, 100), (2, 5)])
+def test_fit_many_varargs_guess(processes, chunk_size):
+    rng = np.random.default_rng(0)
+    x, Y, P = make_n_lorentz_rows(12, 3, rng)
+    popt, perr, success = fitting.fit_many(x, Y, fitting.n_lorentz_function_linoff,
+                                           processes=processes, chunk_size=chunk_size)
+    assert popt.shape == perr.shape == P.shape
+    assert np.all(success)
+    np.testing.assert_allclose(popt[:,3:6], P[:,3:6], atol=0.01)
+    np.testing.assert_allclose(popt[:,6:9], P[:,6:9], rtol=0.05)
+
+def test_fit_many_varargs_p0():
+    rng = np.random.default_rng(1)
+    x, Y, P = make_n_lorentz_rows(4, 2, rng)
+    popt, perr, success = fitting.fit_many(x, Y, fitting.n_lorentz_function_linoff, p0=P*1.02, processes=1)
+    assert popt.shape == P.shape
+    assert np.all(success)
+    np.testing.assert_allclose(popt[:,2:4], P[:,2:4], atol=0.01)
+
+def test_fit_many_failed_rows():
+    rng = np.random.default_rng(2)
+    x, Y, P = make_n_lorentz_rows(3, 2, rng)
+    Y[1] = np.nan
+    popt, perr, success = fitting.fit_many(x, Y, fitting.double_lorentz_function_linoff, processes=1)
+    assert popt.shape == (3, 8)
+    np.testing.assert_array_equal(success, [True, False, True])
+    assert np.all(np.isnan(popt[1]))
+
+def test_guess_n_lorentz_linoff():
+    rng = np.random.default_rng(3)
+    x, Y, P = make_n_lorentz_rows(1, 3, rng)
+    # with the number of peaks found from their prominence above the noise, or given
+    for p0 in [fitting.guess_n_lorentz_linoff(x, Y[0]), fitting.guess_n_lorentz_linoff(x, Y[0], n_peaks=3)]:
+        assert len(p0) == P.shape[1]
+        np.testing.assert_allclose(p0[3:6], P[0,3:6], atol=0.1)
+        np.testing.assert_allclose(p0[6:9], P[0,6:9], rtol=0.5)
+    # dips, and the two most prominent of three peaks
+    p0 = fitting.guess_n_lorentz_linoff(x, -Y[0], n_peaks=2)
+    assert len(p0) == 8
+    assert np.all(np.array(p0[:2]) < 0)
+    with pytest.raises(ValueError):
+        fitting.guess_n_lorentz_linoff(x, fitting.n_lorentz_function_linoff(x, *P[0]), n_peaks=4)
+
+def test_fit_lean_lazy_fit_curve():
+    x = np.linspace(0, 10, 101)
+    y = fitting.exp_function(x, 1.3, 2.4, 0.2)
+    calls = []
+    def exp_function(x, a, t, offset):
+        calls.append(len(x))
+        return fitting.exp_function(x, a, t, offset)
+    result = fitting.fit_lean(x, y, exp_function, p0=[1, 2, 0], plot_pts=50)
+    n_fit_calls = len(calls)
+    np.testing.assert_allclose(result.popt, [1.3, 2.4, 0.2], rtol=1e-6)
+    assert 50 not in calls
+    popt, perr, xp, yp = result
+    assert calls[n_fit_calls:] == [50]
+    np.testing.assert_allclose(yp, fitting.exp_function(xp, *popt))
+    # same return values as fit
+    for a, b in zip(fitting.fit(x, y, fitting.exp_function, p0=[1, 2, 0], plot_pts=50), (popt, perr, xp, yp)):
+        np.testing.assert_allclose(a, b, rtol=1e-6)
@@ -0,0 +1,45 @@
+"""
+Tests of the blockwise spectra in analysis.spectral against scipy.signal.
+"""
+
+import numpy as np
+import scipy.signal
+import pytest
+
+from analysis import spectral
+
+FS = 1e3
+
+
+def make_trace(n_samples):
+    t = np.arange(n_samples)/FS
+    return np.sin(2*np.pi*123.4*t) + np.random.default_rng(0).normal(size=n_samples)*0.1 + 0.3
+
+
+@pytest.mark.parametrize('n_samples', [20000, 20011, 7*256+17])
+def test_psd(n_samples):
+    x = make_trace(n_samples)
+    f, P = spectral.psd(x, FS, nperseg=256, segments_per_block=7)
+    f_ref, P_ref = scipy.signal.welch(x, FS, nperseg=256)
+    np.testing.assert_allclose(f, f_ref)
+    np.testing.assert_allclose(P, P_ref)
+
+@pytest.mark.parametrize('average_segments', [1, 3, 10])
+@pytest.mark.parametrize('n_samples', [20000, 20011, 33333])
+def test_spectrogram_ragged(n_samples, average_segments):
+    # the number of segments is not a multiple of segments_per_block*average_segments
+    x = make_trace(n_samples)
+    f, t, Sxx = spectral.spectrogram(x, FS, nperseg=256, average_segments=average_segments,
+                                     segments_per_block=16, max_workers=2)
+    f_ref, t_ref, S_ref = scipy.signal.spectrogram(x, FS, nperseg=256, noverlap=128, window='hann', mode='psd')
+    n_bins = S_ref.shape[1]//average_segments
+    n = n_bins*average_segments
+    np.testing.assert_allclose(f, f_ref)
+    np.testing.assert_allclose(Sxx, S_ref[:,:n].reshape(len(f_ref), n_bins, average_segments).mean(axis=2).T)
+    np.testing.assert_allclose(t, t_ref[:n].reshape(n_bins, average_segments).mean(axis=1))
+
+def test_spectrogram_shorter_than_a_bin():
+    x = make_trace(256*3)
+    f, t, Sxx = spectral.spectrogram(x, FS, nperseg=256, average_segments=10)
+    assert Sxx.shape == (0, len(f))
+    assert len(t) == 0
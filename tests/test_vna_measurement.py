@@ -0,0 +1,116 @@
+"""
+Tests of VNACWStreamMeasurement against a fake VNA, whose CW stream returns synthetic I/Q blocks.
+"""
+
+import time
+import numpy as np
+import h5py
+
+from lib.vna_measurement_rs import VNACWStreamMeasurement
+
+NPTS = 20
+
+
+class FakeCWStream:
+
+    def __init__(self, block_delay=0.002):
+        self.block_delay = block_delay
+        self.npts = NPTS
+        self.block_duration = 0.01
+        self.blocks = []
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        self.started = True
+
+    def get_block(self):
+        time.sleep(self.block_delay)
+        k = len(self.blocks)
+        block = (float(k), k % 2, np.full(NPTS, k, dtype=np.float64), -np.arange(NPTS, dtype=np.float64)*k)
+        self.blocks.append(block)
+        return block
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeTrace:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def cw_stream(self, *traces, poll_interval=0.001):
+        return self.stream
+
+    def cw_frequency(self):
+        return 5e9
+
+    def bandwidth(self):
+        return 2e3
+
+    def vna_parameter(self):
+        return 'S21'
+
+
+class FakeVNA:
+
+    def __init__(self, stream):
+        self.traces = [FakeTrace(stream)]
+
+    def snapshot(self, update=True):
+        return {}
+
+
+def make_measurement(tmp_path, stream, **params):
+    params = {'duration': 0.3, 'update_time': 0.05, **params}
+    meas = VNACWStreamMeasurement('test', FakeVNA(stream), params=params, base_folder=str(tmp_path))
+    meas.params['do_plot'] = False
+    return meas
+
+def slow_write_blocks(meas, delay):
+    write_blocks = meas._write_blocks
+    def f(dsets, blocks):
+        time.sleep(delay)
+        return write_blocks(dsets, blocks)
+    return f
+
+def check_all_blocks_written(fp, stream):
+    with h5py.File(fp, 'r') as f:
+        t_start, channel, i, q = zip(*stream.blocks)
+        np.testing.assert_array_equal(f['run/block_timestamp'][()], t_start)
+        np.testing.assert_array_equal(f['run/block_channel'][()], channel)
+        np.testing.assert_array_equal(f['run/I'][()], np.stack(i))
+        np.testing.assert_array_equal(f['run/Q'][()], np.stack(q))
+
+
+def test_duration_default(tmp_path):
+    meas = VNACWStreamMeasurement('test', FakeVNA(FakeCWStream()), base_folder=str(tmp_path))
+    assert meas.params['duration'] > 0
+    meas.finish(save_vna_snapshot=False)
+
+def test_stream_to_hdf5(tmp_path):
+    stream = FakeCWStream()
+    meas = make_measurement(tmp_path, stream)
+    finished = []
+    meas.acquisition_finished_callback = lambda: finished.append(True)
+    meas.run(run_identifier='run')
+    meas.finish()
+
+    assert stream.started and stream.stopped
+    assert len(stream.blocks) > 1
+    assert finished == [True]
+    assert meas.blocks_written == len(stream.blocks)
+    check_all_blocks_written(meas.h5datapath, stream)
+
+def test_stop_with_full_queue(tmp_path):
+    # the writer is slower than the stream, so the queue is full and the acquisition thread
+    # is waiting to queue a block when the duration has passed
+    stream = FakeCWStream(block_delay=0)
+    meas = make_measurement(tmp_path, stream, max_queued_blocks=1, duration=0.2)
+    meas._write_blocks = slow_write_blocks(meas, 0.05)
+    meas.run(run_identifier='run')
+    meas.finish(save_vna_snapshot=False)
+
+    assert meas.blocks_written == len(stream.blocks)
+    check_all_blocks_written(meas.h5datapath, stream)
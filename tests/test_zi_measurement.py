@@ -0,0 +1,151 @@
+"""
+Tests of ZIDAQMeasurement against a fake ZI session, whose data server returns synthetic demodulator samples.
+"""
+
+import time
+import threading
+import logging
+import types
+import numpy as np
+import h5py
+import pytest
+
+from lib.zi_measurement import ZIDAQMeasurement
+
+SAMPLE_NODES = ['/dev0/demods/0/sample', '/dev0/demods/1/sample']
+
+
+class FakeDAQServer:
+
+    def __init__(self, samples_per_poll=50, poll_delay=0.002):
+        self.samples_per_poll = samples_per_poll
+        self.poll_delay = poll_delay
+        self.subscribed = []
+        self.polled = {}
+        self.n_polls = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, node):
+        self.subscribed.append(node)
+        self.polled[node] = []
+
+    def unsubscribe(self, node):
+        self.subscribed.remove(node)
+
+    def sync(self):
+        pass
+
+    def poll(self, recording_time, timeout, flags, flat):
+        time.sleep(self.poll_delay)
+        with self.lock:
+            n0 = self.n_polls*self.samples_per_poll
+            self.n_polls += 1
+        data = {}
+        for i,node in enumerate(self.subscribed):
+            t = np.arange(n0, n0+self.samples_per_poll, dtype=np.uint64)
+            sample = {'timestamp': t, 'x': np.cos(t/10.)+i, 'y': np.sin(t/10.)}
+            self.polled[node].append(sample)
+            data[node] = sample
+        return data
+
+
+class FakeDevice:
+
+    def __init__(self, daq_server):
+        self.session = types.SimpleNamespace(daq_server=daq_server)
+
+    def clockbase(self):
+        return 60e6
+
+    def snapshot(self, update=True):
+        return {}
+
+
+def make_measurement(tmp_path, daq_server, **params):
+    params = {'do_plot': False, 'sample_nodes': SAMPLE_NODES, 'duration': 0.3, 'update_time': 0.05,
+              'poll_timeout': 0.05, **params}
+    return ZIDAQMeasurement('test', FakeDevice(daq_server), params=params, base_folder=str(tmp_path))
+
+def slow_get_sample_data(meas, delay, queue_sizes=None):
+    get_sample_data = meas.get_sample_data
+    def f(node_blocks, save_data_keys):
+        if queue_sizes is not None:
+            queue_sizes.append(meas._streamer.queue.qsize())
+        time.sleep(delay)
+        return get_sample_data(node_blocks, save_data_keys)
+    return f
+
+def check_all_polled_samples_written(fp, daq_server):
+    with h5py.File(fp, 'r') as f:
+        for i,node in enumerate(SAMPLE_NODES):
+            polled = daq_server.polled[node]
+            for k in ['timestamp', 'x', 'y']:
+                np.testing.assert_array_equal(f[f'run/data_node-{i}-{k}'][()], np.concatenate([p[k] for p in polled]))
+            x, y = f[f'run/data_node-{i}-x'][()], f[f'run/data_node-{i}-y'][()]
+            np.testing.assert_allclose(f[f'run/data_node-{i}-r'][()], np.hypot(x,y))
+
+
+def test_duration_default(tmp_path):
+    meas = ZIDAQMeasurement('test', FakeDevice(FakeDAQServer()), params={'sample_nodes': SAMPLE_NODES},
+                            base_folder=str(tmp_path))
+    assert meas.params['duration'] > 0
+    meas.finish(save_zi_snapshot=False)
+
+def test_stream_to_hdf5(tmp_path):
+    daq_server = FakeDAQServer()
+    meas = make_measurement(tmp_path, daq_server)
+    finished = []
+    meas.acquisition_finished_callback = lambda: finished.append(True)
+    meas.run(run_identifier='run')
+    meas.finish()
+
+    assert daq_server.n_polls > 1
+    assert daq_server.subscribed == []
+    assert finished == [True]
+    check_all_polled_samples_written(meas.h5datapath, daq_server)
+
+def test_queue_backpressure(tmp_path, caplog):
+    daq_server = FakeDAQServer(poll_delay=0)
+    meas = make_measurement(tmp_path, daq_server, max_queued_polls=2)
+    queue_sizes = []
+    meas.get_sample_data = slow_get_sample_data(meas, 0.05, queue_sizes)
+    with caplog.at_level(logging.WARNING):
+        meas.run(run_identifier='run')
+    meas.finish(save_zi_snapshot=False)
+
+    assert max(queue_sizes) <= 2
+    assert 'polling is throttled' in caplog.text
+    # polling is throttled to the rate of writing (~0.1 s per write), instead of running freely
+    assert daq_server.n_polls < 100
+    check_all_polled_samples_written(meas.h5datapath, daq_server)
+
+def test_final_flush(tmp_path):
+    # the writer is slower than the poller, so polls are still queued when the duration has passed
+    daq_server = FakeDAQServer(poll_delay=0.001)
+    meas = make_measurement(tmp_path, daq_server, max_queued_polls=1000, duration=0.1)
+    queue_sizes = []
+    meas.get_sample_data = slow_get_sample_data(meas, 0.05, queue_sizes)
+    meas.run(run_identifier='run')
+    meas.finish(save_zi_snapshot=False)
+
+    assert max(queue_sizes) > 0
+    np.testing.assert_array_equal(meas.samples_written, [daq_server.n_polls*daq_server.samples_per_poll]*2)
+    check_all_polled_samples_written(meas.h5datapath, daq_server)
+
+def test_writer_exception(tmp_path):
+    daq_server = FakeDAQServer()
+    meas = make_measurement(tmp_path, daq_server, duration=10)
+    def failing_get_sample_data(node_blocks, save_data_keys):
+        raise OSError('disk full')
+    meas.get_sample_data = failing_get_sample_data
+    finished = []
+    meas.acquisition_finished_callback = lambda: finished.append(True)
+
+    t0 = time.time()
+    with pytest.raises(OSError, match='disk full'):
+        meas.run(run_identifier='run')
+    meas.finish(save_zi_snapshot=False)
+
+    assert time.time()-t0 < 5
+    assert finished == []
+    assert daq_server.subscribed == []